@@ -32,6 +32,10 @@ jwt = JWTManager(app)
 from backend import resource        # noqa
 from backend import errors          # noqa
 import backend.common.jwt           # noqa
+import backend.common.stats_counters    # noqa
+import backend.common.suggestions   # noqa
+import backend.common.patient_ngrams    # noqa
+from backend import commands        # noqa
 
 # Initialize ICD10 database
 import backend.common.index_icd10   # noqa
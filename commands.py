@@ -0,0 +1,285 @@
+"""
+Flask CLI commands
+Run with `flask <group> <command>`
+"""
+
+from backend.app import app, db, logger
+from backend.models import Patient, Visit, Lab
+from backend.common.stats_engine import SECTIONS
+from backend.common.stats_counters import rebuild_counters
+from backend.common.suggestions import rebuild_suggestions
+from backend.common.patient_ngrams import rebuild_ngrams
+from backend.common.patient_import import FORMATS, import_patients
+from backend.common.icd10_index import build_index
+from backend.common.index_icd10 import load_icd10
+from backend.common.stats_benchmark import (
+    DATASETS,
+    ENGINES,
+    ClinicDataGenerator,
+    seed_dataset,
+    run_benchmark,
+)
+from collections import Counter, OrderedDict
+from sqlalchemy import exc
+import click
+import json
+
+
+@app.cli.group()
+def stats():
+    """
+    Clinic statistics maintenance
+    """
+
+
+@stats.command("rebuild")
+def rebuild_stats():
+    """
+    Recompute the statistics counters from the base tables
+    """
+
+    try:
+        no_of_counters = rebuild_counters(db.session)
+        db.session.commit()
+
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(e)
+        raise click.ClickException("Unable to rebuild statistics counters.")
+
+    click.echo("Rebuilt {} statistics counters.".format(no_of_counters))
+
+
+@stats.command("seed")
+@click.option(
+    "--dataset",
+    type=click.Choice(list(DATASETS.keys())),
+    default="1k",
+    help="Number of patients.",
+)
+@click.option("--visits-per-patient", default=10, help="Average visits.")
+@click.option("--labs-per-patient", default=4, help="Average labs.")
+@click.option("--seed", default=0, help="Random seed.")
+def seed_stats(dataset, visits_per_patient, labs_per_patient, seed):
+    """
+    Fill an empty database with a synthetic clinic dataset
+    """
+
+    if db.session.query(Patient.query.exists()).scalar():
+        raise click.ClickException("The benchmark needs an empty database.")
+
+    generator = ClinicDataGenerator(
+        seed=seed,
+        visits_per_patient=visits_per_patient,
+        labs_per_patient=labs_per_patient,
+    )
+
+    try:
+        counts = seed_dataset(
+            db.session.connection(), DATASETS[dataset], generator
+        )
+        rebuild_counters(db.session)
+        rebuild_suggestions(db.session)
+        rebuild_ngrams(db.session)
+        db.session.commit()
+
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(e)
+        raise click.ClickException("Unable to seed the benchmark dataset.")
+
+    click.echo(
+        "Seeded {patient} patients, {visit} visits and {lab} labs.".format(
+            **counts
+        )
+    )
+
+
+@stats.command("benchmark")
+@click.option(
+    "--output", default="stats-benchmark.json", help="JSON results file."
+)
+@click.option("--repeat", default=3, help="Runs of each section.")
+@click.option(
+    "--engine",
+    "engines",
+    type=click.Choice(list(ENGINES.keys())),
+    multiple=True,
+    help="Engines to run, all by default.",
+)
+@click.option(
+    "--section",
+    "sections",
+    type=click.Choice(list(SECTIONS.keys())),
+    multiple=True,
+    help="Sections to run, all by default.",
+)
+def benchmark_stats(output, repeat, engines, sections):
+    """
+    Time every statistics section and write the results as JSON
+    """
+
+    dataset = OrderedDict(
+        (model.__tablename__, model.query.count())
+        for model in (Patient, Visit, Lab)
+    )
+    report = run_benchmark(
+        db.engine, dataset, engines=engines, sections=sections, repeat=repeat
+    )
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in report["results"]:
+        click.echo(
+            "{engine:>8} {section:>8} {seconds:>10.3f} s "
+            "{peak_bytes:>12} B {response_bytes:>10} B".format(**result)
+        )
+
+    click.echo("Wrote {}.".format(output))
+
+
+@app.cli.group()
+def suggestions():
+    """
+    Autocomplete suggestion dictionary maintenance
+    """
+
+
+@suggestions.command("rebuild")
+def rebuild_field_suggestions():
+    """
+    Recompute the suggestion dictionary from the base tables
+    """
+
+    try:
+        no_of_suggestions = rebuild_suggestions(db.session)
+        db.session.commit()
+
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(e)
+        raise click.ClickException("Unable to rebuild field suggestions.")
+
+    click.echo("Rebuilt {} field suggestions.".format(no_of_suggestions))
+
+
+@app.cli.group()
+def patients():
+    """
+    Patient search index maintenance
+    """
+
+
+@patients.command("reindex")
+def reindex_patients():
+    """
+    Recompute the n-gram index of every patient
+    """
+
+    try:
+        no_of_patients = rebuild_ngrams(db.session)
+        db.session.commit()
+
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(e)
+        raise click.ClickException("Unable to reindex patients.")
+
+    click.echo("Reindexed {} patients.".format(no_of_patients))
+
+
+@patients.command("import")
+@click.argument("file", type=click.File(encoding="utf-8"))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(FORMATS),
+    help="File format, guessed from the file name by default.",
+)
+@click.option("--batch-size", default=500, help="Rows inserted together.")
+def import_patient_file(file, file_format, batch_size):
+    """
+    Import patients from an NDJSON or CSV file, rows that fail are listed
+    """
+
+    if file_format is None:
+        file_format = "csv" if file.name.endswith(".csv") else "ndjson"
+
+    counts = Counter()
+
+    for result in import_patients(
+        db.session, file, format=file_format, batch_size=batch_size
+    ):
+        counts[result["result"]] += 1
+
+        if result["result"] != "created":
+            click.echo(json.dumps(result, ensure_ascii=False), err=True)
+
+    click.echo(
+        "Imported {} patients, {} invalid, {} conflicting, {} failed.".format(
+            counts["created"],
+            counts["invalid"],
+            counts["conflict"],
+            counts["error"],
+        )
+    )
+
+
+@app.cli.group()
+def icd10():
+    """
+    ICD10 code set maintenance
+    """
+
+
+@icd10.command("load")
+@click.option(
+    "--file", "path", default=None, help="Code file, ICD10_FILE by default."
+)
+@click.option("--force", is_flag=True, help="Reload the same version.")
+def load_icd10_codes(path, force):
+    """
+    Load or upgrade the ICD10 codes in the DB from a code file
+    """
+
+    try:
+        counts = load_icd10(
+            db.session, path or app.config["ICD10_FILE"], force
+        )
+        db.session.commit()
+
+    except (IOError, OSError, exc.SQLAlchemyError) as e:
+        db.session.rollback()
+        logger.error(e)
+        raise click.ClickException("Unable to load the ICD10 codes.")
+
+    if counts is None:
+        click.echo("ICD10 codes are up to date.")
+
+    else:
+        click.echo(
+            "ICD10 codes: {added} added, {changed} changed, "
+            "{retired} retired.".format(**counts)
+        )
+
+
+@icd10.command("snapshot")
+def snapshot_icd10():
+    """
+    Build the ICD10 index snapshot of the loaded code set before starting
+    the workers
+    """
+
+    try:
+        index = build_index()
+
+    except (IOError, OSError, exc.SQLAlchemyError) as e:
+        logger.error(e)
+        raise click.ClickException("Unable to build the ICD10 snapshot.")
+
+    click.echo(
+        "ICD10 snapshot {} holds {} codes.".format(
+            app.config["ICD10_SNAPSHOT"], len(index)
+        )
+    )
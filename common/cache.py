@@ -0,0 +1,168 @@
+"""
+In-process Result Cache
+Thread-safe LRU cache with TTL, size bound and single-flight computation
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class _Flight(object):
+    """
+    A computation in progress, other callers wait for its result
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache(object):
+    """
+    LRU cache bounded by number of entries and total size
+    """
+
+    def __init__(self, maxsize=128, ttl=None, max_bytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def get_or_compute(self, key, compute, ttl=None, cacheable=None):
+        """
+        Return the cached value, or compute it once for all the callers
+        Values rejected by cacheable are shared with the waiting callers
+        but not stored
+        """
+
+        with self._lock:
+            entry = self._lookup(key)
+
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            flight = self._flights.get(key)
+            is_leader = flight is None
+
+            if is_leader:
+                flight = self._flights[key] = _Flight()
+
+        if not is_leader:
+            flight.done.wait()
+
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.value
+
+        try:
+            flight.value = compute()
+
+            if cacheable is None or cacheable(flight.value):
+                with self._lock:
+                    self._store(key, flight.value, ttl)
+
+            return flight.value
+
+        except Exception as e:
+            flight.error = e
+            raise
+
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+            flight.done.set()
+
+    def invalidate(self, predicate=None):
+        """
+        Remove the entries whose key matches the predicate, or all entries
+        """
+
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if predicate is None or predicate(key):
+                    self._remove(key)
+
+    def clear(self):
+        self.invalidate()
+
+    def info(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxsize": self.maxsize,
+                "max_bytes": self.max_bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        value, expires, size = entry
+
+        if expires is not None and expires < time.monotonic():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self._remove(key)
+        self._entries[key] = (value, expires, size)
+        self._bytes += size
+
+        # Evict least recently used entries
+        while len(self._entries) > self.maxsize or (
+            self.max_bytes is not None and self._bytes > self.max_bytes
+        ):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._bytes -= entry[2]
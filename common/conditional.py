@@ -0,0 +1,60 @@
+"""
+Conditional GET
+Validators are computed from a cheap aggregate of modify_timestamp, the
+records are only loaded and serialized when the client copy is stale
+"""
+
+from flask import Response, jsonify, request
+import hashlib
+
+
+def record_etag(*parts):
+    """
+    Weak validator of a record or a collection, e.g. its count and latest
+    modify_timestamp
+    """
+
+    return hashlib.sha1(
+        "|".join(str(part) for part in parts).encode()
+    ).hexdigest()
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Whether the copy held by the client is current
+    If-None-Match takes precedence over If-Modified-Since
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified:
+        # HTTP dates have a resolution of one second
+        since = request.if_modified_since.replace(tzinfo=None)
+
+        return last_modified.replace(microsecond=0) <= since
+
+    return False
+
+
+def conditional_response(etag, last_modified, build):
+    """
+    304 when the client copy is current, otherwise the JSON of build()
+    Without last_modified only the ETag validates the response
+    """
+
+    if is_not_modified(etag, last_modified):
+        response = Response(status=304)
+
+    else:
+        response = jsonify(build())
+
+    response.set_etag(etag, weak=True)
+    # Cached copies are revalidated on every use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    return response
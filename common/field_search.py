@@ -0,0 +1,189 @@
+"""
+Form Field Autocomplete
+ICD10 codes come from the in-process index, patients from full text search
+and free-text fields from the suggestion dictionary. Results are cached
+across requests by field and normalized query
+"""
+
+from backend.app import app, db, logger
+from backend.models import (
+    Patient,
+    Visit,
+    Imaging,
+    Appointment,
+    ICD10,
+    FieldSuggestion,
+)
+from backend.common.cache import ResultCache
+from backend.common.icd10_index import icd10_index, icd10_version
+from backend.common.patient_search import search_patients, ngram_patients
+from collections import OrderedDict
+from functools import partial
+from sqlalchemy import event, func, desc
+
+# Autocomplete field name -> column
+FREE_TEXT_FIELDS = OrderedDict(
+    [
+        ("refer_from", Patient.refer_from),
+        ("art_adherence_problem", Visit.art_adherence_problem),
+        ("why_switched_arv", Visit.why_switched_arv),
+        ("film_type", Imaging.film_type),
+        ("result", Imaging.result),
+        ("appointment_for", Appointment.appointment_for),
+    ]
+)
+
+
+# Cached results of this worker, (field name, query, version) -> list
+search_cache = ResultCache(maxsize=app.config["SEARCH_CACHE_SIZE"])
+
+WRITTEN_KEY = "search_cache_written"
+
+
+def escape_like(value, escape="\\"):
+    """
+    Match LIKE wildcards in the user input literally
+    """
+
+    return (
+        value.replace(escape, escape * 2)
+        .replace("%", escape + "%")
+        .replace("_", escape + "_")
+    )
+
+
+def free_text_entries(field_name, query, limit):
+    """
+    Used values of a free-text field containing the query
+    """
+
+    value = FieldSuggestion.value
+    pattern = escape_like(query)
+
+    rows = (
+        db.session.query(value)
+        .filter(
+            FieldSuggestion.field_name == field_name,
+            FieldSuggestion.usage_count > 0,
+            value.ilike("%{}%".format(pattern), escape="\\"),
+        )
+        .order_by(
+            desc(FieldSuggestion.usage_count),
+            desc(func.similarity(value, query)),
+            desc(value.ilike("{}%".format(pattern), escape="\\")),
+            value,
+        )
+        .limit(limit)
+        .all()
+    )
+
+    return [row[0] for row in rows]
+
+
+def icd10_entries(query, limit):
+    """
+    ICD10 codes, full text search on the DB is the fallback
+    """
+
+    index = icd10_index()
+    results = index.search(query, limit) if index is not None else []
+
+    if not results:
+        query_results = (
+            ICD10.query.filter(ICD10.retired_version.is_(None))
+            .search(query, sort=True)
+            .limit(limit)
+            .all()
+        )
+        results = [
+            "{}: {}".format(r.icd10, r.description) for r in query_results
+        ]
+
+    return results
+
+
+def patient_entries(query, limit):
+    """
+    First page of the patients matching the search bar query, substring
+    matches first, full text search for queries too short for n-grams
+    """
+
+    return ngram_patients(query, limit) or search_patients(query, limit)[0]
+
+
+# Field name -> (search, models whose writes change the results)
+SEARCH_FIELDS = OrderedDict(
+    [
+        ("imp", (icd10_entries, ())),
+        ("search_bar", (patient_entries, (Patient,))),
+    ]
+    + [
+        (
+            field_name,
+            (partial(free_text_entries, field_name), (column.class_,)),
+        )
+        for field_name, column in FREE_TEXT_FIELDS.items()
+    ]
+)
+
+
+def normalize_query(query):
+    return " ".join(query.split()).lower()
+
+
+def search_field_entries(field_name, query):
+    """
+    Cached autocomplete entries of one of the SEARCH_FIELDS
+    ICD10 entries are keyed by the loaded code set, the others are dropped
+    when this worker commits a write of their models. Every entry expires
+    after the TTL
+    """
+
+    search, _ = SEARCH_FIELDS[field_name]
+    query = normalize_query(query)
+    version = icd10_version() if field_name == "imp" else None
+
+    return search_cache.get_or_compute(
+        (field_name, query, version),
+        lambda: search(query, app.config["MAX_SEARCH_RESULT"]),
+        ttl=app.config["SEARCH_CACHE_TTL"],
+    )
+
+
+def mark_written(session, models):
+    """
+    Invalidate the searches of models written without the ORM on commit
+    """
+
+    session.info.setdefault(WRITTEN_KEY, set()).update(models)
+
+
+@event.listens_for(db.session, "after_flush")
+def collect_written_models(session, flush_context):
+    for objs in (session.new, session.dirty, session.deleted):
+        mark_written(session, {type(obj) for obj in objs})
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_search_cache(session):
+    """
+    Drop the cached results of the fields whose models were written
+    """
+
+    written = session.info.pop(WRITTEN_KEY, set())
+    fields = {
+        field_name
+        for field_name, (_, models) in SEARCH_FIELDS.items()
+        if written.intersection(models)
+    }
+
+    if fields:
+        logger.debug(
+            "Invalidating cached searches: {}.".format(", ".join(fields))
+        )
+        search_cache.invalidate(lambda key: key[0] in fields)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_written_models(session):
+    session.info.pop(WRITTEN_KEY, None)
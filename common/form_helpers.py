@@ -1,6 +1,11 @@
 from datetime import datetime
 from pytz import timezone
 from backend.app import app
+from flask import request
+import copy
+
+# Content type of partial updates, RFC 7386
+MERGE_PATCH_MIMETYPE = "application/merge-patch+json"
 
 
 def ISODateType(date_str):
@@ -17,3 +22,24 @@ def ISODateType(date_str):
 
 def convert_to_utc(date_obj):
     return date_obj.replace(tzinfo=timezone("UTC"))
+
+
+def is_merge_patch():
+    return request.mimetype == MERGE_PATCH_MIMETYPE
+
+
+def merge_patch_args(args):
+    """
+    Form arguments of a merge patch, every field is optional and null
+    clears the fields that are not required
+    """
+
+    patch_args = {}
+
+    for name, field in args.items():
+        field = copy.copy(field)
+        field.allow_none = not field.required
+        field.required = False
+        patch_args[name] = field
+
+    return patch_args
@@ -0,0 +1,468 @@
+"""
+In-process ICD10 Index
+The ICD10 code set is static, it is indexed into sorted arrays searched with
+bisect and an inverted index of description tokens. The arrays are saved as
+a binary snapshot that every worker memory-maps read-only. The snapshot is
+keyed on the code set loaded in the DB, retired codes are not indexed
+"""
+
+from backend.app import app, db, logger
+from backend.models import ICD10, CodeSet
+from sqlalchemy import exc, select
+from bisect import bisect_left
+from array import array
+import hashlib
+import heapq
+import struct
+import mmap
+import threading
+import time
+import os
+import re
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+CODE_QUERY = re.compile(r"^[A-Za-z]\d[0-9A-Za-z.]*$")
+
+# Shorter query tokens only match whole words, a single letter prefix
+# would match most of the code set
+MIN_TOKEN_PREFIX = 2
+
+
+def normalize_code(code):
+    return code.replace(".", "").strip().upper()
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+def prefix_range(values, prefix):
+    """
+    Slice of the sorted values starting with prefix
+    """
+
+    start = bisect_left(values, prefix)
+    end = bisect_left(values, prefix + "\uffff", lo=start)
+
+    return start, end
+
+
+class ICD10Index(object):
+    """
+    Code prefix and ranked description token prefix lookup
+    Works on lists or on the memory-mapped tables of a snapshot
+    """
+
+    def __init__(self, keys, codes, descriptions, tokens, postings):
+        self.keys = keys
+        self.codes = codes
+        self.descriptions = descriptions
+        self.tokens = tokens
+        self.postings = postings
+
+    @classmethod
+    def from_entries(cls, entries):
+        entries = sorted(
+            (normalize_code(code), code, description)
+            for code, description in entries
+        )
+        descriptions = [description for _, _, description in entries]
+
+        # Token -> sorted entry positions
+        postings = {}
+
+        for position, description in enumerate(descriptions):
+            for token in set(tokenize(description)):
+                postings.setdefault(token, []).append(position)
+
+        tokens = sorted(postings.keys())
+
+        return cls(
+            [key for key, _, _ in entries],
+            [code for _, code, _ in entries],
+            descriptions,
+            tokens,
+            [postings[token] for token in tokens],
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+    def label(self, position):
+        return "{}: {}".format(
+            self.codes[position], self.descriptions[position]
+        )
+
+    def code_prefix(self, query, limit):
+        """
+        Positions of the codes starting with query, in code order
+        """
+
+        start, end = prefix_range(self.keys, normalize_code(query))
+
+        return list(range(start, min(end, start + limit)))
+
+    def token_prefix(self, query, limit):
+        """
+        Positions of the descriptions with a token starting with every
+        query token, whole word matches and shorter descriptions first
+        """
+
+        query_tokens = tokenize(query)
+
+        if not query_tokens:
+            return []
+
+        candidates = None
+        exact = {}
+
+        ranges = []
+
+        for token in query_tokens:
+            start, end = prefix_range(self.tokens, token)
+
+            if len(token) < MIN_TOKEN_PREFIX:
+                end = start + int(start < end and self.tokens[start] == token)
+
+            ranges.append((token, start, end))
+
+        # Rarest token first keeps the intersections small
+        ranges.sort(
+            key=lambda r: sum(len(self.postings[i]) for i in range(*r[1:]))
+        )
+
+        for token, start, end in ranges:
+            matches = set()
+
+            for i in range(start, end):
+                matches.update(self.postings[i])
+
+                if self.tokens[i] == token:
+                    for position in self.postings[i]:
+                        exact[position] = exact.get(position, 0) + 1
+
+            candidates = (
+                matches if candidates is None else candidates & matches
+            )
+
+            if not candidates:
+                return []
+
+        return heapq.nsmallest(
+            limit,
+            candidates,
+            key=lambda p: (-exact.get(p, 0), len(self.descriptions[p]), p),
+        )
+
+    def search(self, query, limit):
+        """
+        Code matches first, then description matches
+        """
+
+        positions = []
+
+        if CODE_QUERY.match(query.strip()):
+            positions = self.code_prefix(query, limit)
+
+        if len(positions) < limit:
+            seen = set(positions)
+            positions.extend(
+                p
+                for p in self.token_prefix(query, limit + len(seen))
+                if p not in seen
+            )
+
+        return [self.label(p) for p in positions[:limit]]
+
+
+def read_icd10_file(path):
+    """
+    (code, description) of every line of the ICD10-CM code file
+    """
+
+    with open(path) as file:
+        for line in file:
+            columns = line.rstrip().split(maxsplit=1)
+
+            if len(columns) == 2:
+                yield columns[0], columns[1]
+
+
+# Snapshot layout, native byte order:
+# header, uint32 tables of key, code, description and token offsets into
+# the string arena, uint32 posting offsets and postings, then the arena
+SNAPSHOT_MAGIC = b"ICD10IX1"
+SNAPSHOT_HEADER = struct.Struct("=8s32sIIII")
+
+
+class StringTable(object):
+    """
+    Read-only sequence of the strings stored in an arena
+    """
+
+    def __init__(self, arena, offsets):
+        self.arena = arena
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.arena[self.offsets[i] : self.offsets[i + 1]], "utf-8")
+
+
+class PostingTable(object):
+    """
+    Read-only sequence of the posting lists of every token
+    """
+
+    def __init__(self, postings, offsets):
+        self.postings = postings
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.postings[self.offsets[i] : self.offsets[i + 1]]
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+
+    return digest.digest()
+
+
+def write_snapshot(index, path, checksum):
+    """
+    Save the index arrays, the file is replaced atomically
+    """
+
+    arena = bytearray()
+    tables = []
+
+    for strings in (index.keys, index.codes, index.descriptions, index.tokens):
+        offsets = array("I", [len(arena)])
+
+        for string in strings:
+            arena.extend(string.encode("utf-8"))
+            offsets.append(len(arena))
+
+        tables.append(offsets)
+
+    posting_offsets = array("I", [0])
+    postings = array("I")
+
+    for positions in index.postings:
+        postings.extend(positions)
+        posting_offsets.append(len(postings))
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+
+    with open(tmp_path, "wb") as file:
+        file.write(
+            SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC,
+                checksum,
+                len(index.keys),
+                len(index.tokens),
+                len(postings),
+                len(arena),
+            )
+        )
+
+        for table in tables + [posting_offsets, postings]:
+            table.tofile(file)
+
+        file.write(arena)
+
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path, checksum):
+    """
+    Memory-map a snapshot, returns None when it is missing or stale
+    """
+
+    try:
+        with open(path, "rb") as file:
+            snapshot = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    except (IOError, OSError, ValueError):
+        return None
+
+    if len(snapshot) < SNAPSHOT_HEADER.size:
+        return None
+
+    header = SNAPSHOT_HEADER.unpack_from(snapshot)
+    magic, source_checksum, entries, tokens, postings, arena_size = header
+
+    if magic != SNAPSHOT_MAGIC or source_checksum != checksum:
+        return None
+
+    view = memoryview(snapshot)
+    position = SNAPSHOT_HEADER.size
+    sizes = [entries + 1] * 3 + [tokens + 1] * 2 + [postings]
+    tables = []
+
+    for size in sizes:
+        end = position + size * 4
+        tables.append(view[position:end].cast("I"))
+        position = end
+
+    arena = view[position : position + arena_size]
+
+    if len(arena) != arena_size:
+        return None
+
+    key_offsets, code_offsets, description_offsets = tables[:3]
+    token_offsets, posting_offsets, posting_table = tables[3:]
+
+    return ICD10Index(
+        StringTable(arena, key_offsets),
+        StringTable(arena, code_offsets),
+        StringTable(arena, description_offsets),
+        StringTable(arena, token_offsets),
+        PostingTable(posting_table, posting_offsets),
+    )
+
+
+def code_set_checksum(version, checksum):
+    return hashlib.sha256("{}:{}".format(version, checksum).encode()).digest()
+
+
+def index_source(connection):
+    """
+    (checksum, entries) of the loaded code set without the retired codes,
+    the code file until the codes are loaded into the DB
+    """
+
+    code_set = connection.execute(
+        select([CodeSet.version, CodeSet.checksum]).where(
+            CodeSet.name == "icd10"
+        )
+    ).first()
+
+    if code_set is None:
+        path = app.config["ICD10_FILE"]
+
+        return file_checksum(path), lambda: read_icd10_file(path)
+
+    def entries():
+        return connection.execute(
+            select([ICD10.icd10, ICD10.description]).where(
+                ICD10.retired_version.is_(None)
+            )
+        )
+
+    return code_set_checksum(*code_set), entries
+
+
+def load_index(snapshot, checksum, entries):
+    """
+    Map the snapshot of the code set, rebuild it if the code set changed
+    """
+
+    index = read_snapshot(snapshot, checksum)
+
+    if index is None:
+        logger.info("Building ICD10 index snapshot {}.".format(snapshot))
+        index = ICD10Index.from_entries(entries())
+
+        try:
+            write_snapshot(index, snapshot, checksum)
+
+        except (IOError, OSError) as e:
+            # Keep the index of this worker in memory
+            logger.error("Unable to write ICD10 index snapshot.")
+            logger.error(e)
+            return index
+
+        index = read_snapshot(snapshot, checksum) or index
+
+    return index
+
+
+def build_index():
+    """
+    Index of the current code set, the snapshot is rebuilt as needed
+    """
+
+    with db.engine.connect() as connection:
+        checksum, entries = index_source(connection)
+
+        return load_index(app.config["ICD10_SNAPSHOT"], checksum, entries)
+
+
+# Seconds between two checks of the loaded code set version
+VERSION_CHECK_INTERVAL = 60
+
+_index = None
+_index_checksum = None
+_index_checked = None
+_index_lock = threading.Lock()
+
+
+def is_checked():
+    return (
+        _index_checked is not None
+        and time.monotonic() - _index_checked < VERSION_CHECK_INTERVAL
+    )
+
+
+def icd10_index():
+    """
+    Index of the worker, mapped on first use and remapped when another
+    code set version is loaded. Returns None when no code set is available
+    """
+
+    global _index, _index_checksum, _index_checked
+
+    if is_checked():
+        return _index
+
+    # Only the first load waits, while one thread checks the version or
+    # rebuilds the index the others keep searching the current one
+    if not _index_lock.acquire(blocking=_index is None):
+        return _index
+
+    try:
+        if is_checked():
+            return _index
+
+        try:
+            with db.engine.connect() as connection:
+                checksum, entries = index_source(connection)
+
+                if checksum != _index_checksum:
+                    _index = load_index(
+                        app.config["ICD10_SNAPSHOT"], checksum, entries
+                    )
+                    _index_checksum = checksum
+                    logger.info("Loaded {} ICD10 codes.".format(len(_index)))
+
+        except (IOError, OSError, exc.SQLAlchemyError) as e:
+            # Keep serving the previous index, retried after the interval
+            logger.error("Unable to index ICD10 codes.")
+            logger.error(e)
+
+        _index_checked = time.monotonic()
+
+    finally:
+        _index_lock.release()
+
+    return _index
+
+
+def icd10_version():
+    """
+    Checksum of the code set searched by the index of the worker
+    """
+
+    icd10_index()
+
+    return _index_checksum
@@ -1,24 +1,222 @@
 from backend.app import app, logger, db
-from backend.models import ICD10, User
-from sqlalchemy import exc
+from backend.models import ICD10, User, CodeSet
+from backend.common.icd10_index import (
+    icd10_index,
+    read_icd10_file,
+    file_checksum,
+)
+from sqlalchemy import exc, text
+from collections import OrderedDict
+from datetime import datetime
 import threading
 import time
+import os
 
 import bcrypt
 
+# pg_advisory_xact_lock key, one ICD10 loader at a time across processes
+ICD10_LOCK_KEY = 0x1CD10
 
-@app.before_first_request
-def activate_job():
-    # https://networklore.com/start-task-with-flask/
+# Trigger filling icd10.search_vector, created by sqlalchemy_searchable
+ICD10_SEARCH_TRIGGER = "icd10_search_vector_trigger"
+
+# Same configuration as ICD10.search_vector
+ICD10_REGCONFIG = "pg_catalog.english"
+
+
+def copy_text(value):
+    """
+    Escape a value for the text format of COPY
+    """
+
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class CopyStream(object):
+    """
+    File-like object streaming rows to COPY ... FROM STDIN
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = bytearray()
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+
+            except StopIteration:
+                break
+
+            self.buffer.extend(
+                ("\t".join(copy_text(v) for v in row) + "\n").encode("utf-8")
+            )
+            self.count += 1
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+
+def code_set_version(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def load_icd10(session, path, force=False):
+    """
+    Load or upgrade the ICD10 codes from a code file streamed with COPY
+    Returns the number of added, changed and retired codes, None when
+    this version is already loaded
+    """
+
+    # Released at the end of the transaction
+    session.execute(
+        text("SELECT pg_advisory_xact_lock(:key)"), {"key": ICD10_LOCK_KEY}
+    )
+
+    checksum = file_checksum(path).hex()
+    version = code_set_version(path)
+    code_set = CodeSet.query.filter_by(name="icd10").first()
+
+    if code_set and code_set.checksum == checksum and not force:
+        return None
+
+    session.execute(
+        text(
+            """
+            CREATE TEMPORARY TABLE icd10_load (
+                icd10 text PRIMARY KEY,
+                description text NOT NULL
+            ) ON COMMIT DROP
+            """
+        )
+    )
+
+    stream = CopyStream(read_icd10_file(path))
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(
+        "COPY icd10_load (icd10, description) FROM STDIN", stream
+    )
+    session.execute(text("ANALYZE icd10_load"))
+
+    is_table_empty = not session.query(ICD10.query.exists()).scalar()
 
-    def read_icd10_file():
-        icd10_file_path = "./backend/icd10cm_codes_2019.txt"
+    if is_table_empty:
+        counts = bulk_insert_icd10(session, version)
 
-        with open(icd10_file_path) as file:
-            for line in file:
-                columns = line.rstrip().split(maxsplit=1)
+    else:
+        counts = apply_icd10_diff(session, version)
 
-                yield {"icd10": columns[0], "description": columns[1]}
+    if code_set is None:
+        code_set = CodeSet(name="icd10")
+        session.add(code_set)
+
+    code_set.version = version
+    code_set.checksum = checksum
+    code_set.rows = stream.count
+    code_set.loaded_at = datetime.utcnow()
+
+    return counts
+
+
+def bulk_insert_icd10(session, version):
+    """
+    First load, rows are inserted without the row trigger and with the
+    search vectors the trigger would compute
+    """
+
+    session.execute(
+        text(
+            "ALTER TABLE icd10 DISABLE TRIGGER {}".format(ICD10_SEARCH_TRIGGER)
+        )
+    )
+    added = session.execute(
+        text(
+            """
+            INSERT INTO icd10 (icd10, description, version, timestamp,
+                modify_timestamp, search_vector)
+            SELECT icd10, description, :version, now(), now(),
+                to_tsvector(CAST(:regconfig AS regconfig), icd10)
+                || to_tsvector(CAST(:regconfig AS regconfig), description)
+            FROM icd10_load
+            """
+        ),
+        {"version": version, "regconfig": ICD10_REGCONFIG},
+    ).rowcount
+    session.execute(
+        text(
+            "ALTER TABLE icd10 ENABLE TRIGGER {}".format(ICD10_SEARCH_TRIGGER)
+        )
+    )
+
+    return OrderedDict([("changed", 0), ("added", added), ("retired", 0)])
+
+
+def apply_icd10_diff(session, version):
+    """
+    Upgrade to a new release, only the added, changed and retired codes
+    are written. Searches see the previous set until the commit
+    """
+
+    statements = OrderedDict(
+        [
+            (
+                "changed",
+                """
+                UPDATE icd10
+                SET description = l.description, version = :version,
+                    retired_version = NULL, modify_timestamp = now()
+                FROM icd10_load AS l
+                WHERE icd10.icd10 = l.icd10
+                    AND (icd10.description <> l.description
+                        OR icd10.retired_version IS NOT NULL)
+                """,
+            ),
+            (
+                "added",
+                """
+                INSERT INTO icd10 (icd10, description, version, timestamp,
+                    modify_timestamp)
+                SELECT l.icd10, l.description, :version, now(), now()
+                FROM icd10_load AS l
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM icd10 WHERE icd10.icd10 = l.icd10
+                )
+                """,
+            ),
+            (
+                "retired",
+                """
+                UPDATE icd10
+                SET retired_version = :version, modify_timestamp = now()
+                WHERE retired_version IS NULL AND NOT EXISTS (
+                    SELECT 1 FROM icd10_load AS l WHERE l.icd10 = icd10.icd10
+                )
+                """,
+            ),
+        ]
+    )
+
+    return OrderedDict(
+        (name, session.execute(text(sql), {"version": version}).rowcount)
+        for name, sql in statements.items()
+    )
+
+
+@app.before_first_request
+def activate_job():
+    # https://networklore.com/start-task-with-flask/
 
     def insert_icd10_into_db():
         """
@@ -28,26 +226,24 @@ def activate_job():
 
         while not task_finished:
             try:
-                is_table_empty = not bool(ICD10.query.first())
-
-                if is_table_empty:
-                    logger.info("Inserting ICD10 codes to DB...")
-                    icd10_codes = read_icd10_file()
+                counts = load_icd10(db.session, app.config["ICD10_FILE"])
+                db.session.commit()
 
-                    for icd10_code in icd10_codes:
-                        icd10 = ICD10(**icd10_code)
-                        db.session.add(icd10)
-
-                    db.session.commit()
-
-                else:
+                if counts is None:
                     logger.debug(
                         "No need to insert ICD10 codes into the DB..."
                     )
 
+                else:
+                    logger.info(
+                        "ICD10 codes {added} added, {changed} changed, "
+                        "{retired} retired...".format(**counts)
+                    )
+
                 task_finished = True
 
             except exc.SQLAlchemyError as e:
+                db.session.rollback()
                 logger.debug(
                     "Unable to connect to the DB, retrying in 5 sec..."
                 )
@@ -55,6 +251,12 @@ def activate_job():
 
                 time.sleep(5)
 
+            except (IOError, OSError) as e:
+                logger.error("Unable to read the ICD10 codes.")
+                logger.error(e)
+
+                task_finished = True
+
     def run_job():
         # Looking for default user tb01:tb01
         is_table_empty = not bool(User.query.first())
@@ -68,9 +270,13 @@ def activate_job():
             db.session.add(user)
             db.session.commit()
 
-            # insert icd10 data
+        # insert icd10 data, the other workers wait for the lock
+        if app.config["ICD10_LOAD_ON_STARTUP"]:
             insert_icd10_into_db()
             logger.info("Done indexing ICD10 codes...")
 
     thread = threading.Thread(target=run_job)
     thread.start()
+
+    # Build the in-memory ICD10 index before the first search
+    threading.Thread(target=icd10_index).start()
@@ -0,0 +1,251 @@
+"""
+Bulk Patient Import
+Rows of an NDJSON or CSV stream are validated with the patient form schema,
+checked for uniqueness once per batch and inserted with a multi-row INSERT.
+Counters, suggestions, n-grams and cached searches are updated in the same
+transaction as each batch
+"""
+
+from backend.app import logger
+from backend.models import Patient
+from backend.common.patient_schema import PatientSchema
+from backend.common.patient_ngrams import NGRAM_COLUMNS, write_ngrams
+from backend.common.stats_counters import (
+    CONTRIBUTIONS,
+    mark_data_written,
+    write_counter_deltas,
+)
+from backend.common.suggestions import (
+    SUGGESTION_FIELDS,
+    suggestion_values,
+    write_suggestion_deltas,
+)
+from backend.common.field_search import mark_written
+from sqlalchemy import exc
+from collections import Counter, OrderedDict
+from datetime import datetime
+import json
+import csv
+
+FORMATS = ["ndjson", "csv"]
+
+# Rows validated, checked and inserted together
+BATCH_SIZE = 500
+
+
+def read_ndjson(lines):
+    """
+    One object per non-blank line, a malformed line is returned as the
+    error message
+    """
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+
+        except ValueError as e:
+            yield str(e)
+            continue
+
+        yield row if isinstance(row, dict) else "Expected a JSON object."
+
+
+def read_csv(lines):
+    """
+    One object per row, blank cells are missing values and the list
+    columns hold JSON arrays
+    """
+
+    for row in csv.DictReader(lines):
+        data = {}
+
+        try:
+            for key, value in row.items():
+                if key is None or value is None or not value.strip():
+                    continue
+
+                if key in Patient.__json__:
+                    value = json.loads(value)
+
+                data[key] = value
+
+        except ValueError as e:
+            yield "{}: {}".format(key, e)
+            continue
+
+        yield data
+
+
+READERS = {"ndjson": read_ndjson, "csv": read_csv}
+
+
+def validate_row(row):
+    """
+    Column values of a row or the validation errors
+    """
+
+    if not isinstance(row, dict):
+        return None, {"row": [row]}
+
+    data, errors = PatientSchema().load(row)
+
+    if errors:
+        return None, errors
+
+    return Patient.convert_to_json(data), None
+
+
+def row_result(no, hn, result, **details):
+    return OrderedDict(
+        [("row", no), ("hn", hn), ("result", result)] + sorted(details.items())
+    )
+
+
+def insert_batch(session, batch):
+    """
+    Insert validated (row number, values) pairs in one statement and
+    apply their side effects. Returns the id of every HN
+    """
+
+    now = datetime.utcnow()
+    columns = set()
+
+    for _, values in batch:
+        columns.update(values.keys())
+
+    rows = [
+        dict(
+            {c: values.get(c) for c in columns},
+            timestamp=now,
+            modify_timestamp=now,
+        )
+        for _, values in batch
+    ]
+
+    inserted = session.execute(
+        Patient.__table__.insert()
+        .values(rows)
+        .returning(Patient.__table__.c.id, Patient.__table__.c.hn)
+    ).fetchall()
+    ids = {hn: patient_id for patient_id, hn in inserted}
+
+    logger.debug("Imported {} patients.".format(len(ids)))
+
+    # What the flush listeners do for ORM writes
+    contributions, counted = CONTRIBUTIONS[Patient]
+    counters = Counter()
+    suggestions = Counter()
+
+    for row in rows:
+        counters.update(contributions({c: row.get(c) for c in counted}))
+        suggestions.update(
+            suggestion_values(
+                {c: row.get(c) for c in SUGGESTION_FIELDS.get(Patient, [])}
+            )
+        )
+
+    write_counter_deltas(session, counters)
+    write_suggestion_deltas(session, suggestions)
+    write_ngrams(
+        session,
+        [
+            (ids[row["hn"]], {c: row.get(c) for c in NGRAM_COLUMNS})
+            for row in rows
+        ],
+    )
+    mark_written(session, [Patient])
+    mark_data_written(session)
+
+    return ids
+
+
+def import_batch(session, batch):
+    """
+    Check and insert one batch of (row number, raw row) pairs
+    Returns the result of every row in row order
+    """
+
+    results = []
+    valid = []
+
+    for no, row in batch:
+        values, errors = validate_row(row)
+
+        if errors:
+            hn = row.get("hn") if isinstance(row, dict) else None
+            results.append(row_result(no, hn, "invalid", errors=errors))
+
+        else:
+            valid.append((no, values))
+
+    taken = Patient.taken_values(
+        {
+            col: [values[col] for _, values in valid if values.get(col)]
+            for col in Patient.__unique__
+        }
+    )
+    accepted = []
+
+    for no, values in valid:
+        conflicts = [
+            col
+            for col in Patient.__unique__
+            if values.get(col) and values[col] in taken.get(col, ())
+        ]
+
+        if conflicts:
+            results.append(
+                row_result(no, values["hn"], "conflict", fields=conflicts)
+            )
+            continue
+
+        # Later rows of the batch conflict with this one
+        for col in Patient.__unique__:
+            if values.get(col):
+                taken.setdefault(col, set()).add(values[col])
+
+        accepted.append((no, values))
+
+    result = "created"
+
+    if accepted:
+        try:
+            insert_batch(session, accepted)
+            session.commit()
+
+        except exc.SQLAlchemyError as e:
+            # A concurrent write took a unique value, the batch is rejected
+            session.rollback()
+            logger.error("Unable to import a batch of patients.")
+            logger.error(e)
+            result = "error"
+
+    results.extend(
+        row_result(no, values["hn"], result) for no, values in accepted
+    )
+
+    return sorted(results, key=lambda r: r["row"])
+
+
+def import_patients(session, lines, format="ndjson", batch_size=BATCH_SIZE):
+    """
+    Import the rows of a text stream, yields the result of every row
+    in order as soon as its batch is committed
+    """
+
+    batch = []
+
+    for no, row in enumerate(READERS[format](lines), start=1):
+        batch.append((no, row))
+
+        if len(batch) >= batch_size:
+            for result in import_batch(session, batch):
+                yield result
+
+            batch = []
+
+    for result in import_batch(session, batch):
+        yield result
@@ -0,0 +1,154 @@
+"""
+Patient N-gram Index
+Thai names are not space-segmented, so infix search uses character bigrams
+and trigrams of the searchable columns, kept in sync on every patient write
+"""
+
+from backend.app import db, logger
+from backend.models import Patient, PatientNgram
+from sqlalchemy import event, inspect, text
+import unicodedata
+
+# Searchable patient columns
+NGRAM_COLUMNS = ["name", "hn", "gov_id", "nap", "refer_from"]
+NGRAM_SIZES = (2, 3)
+
+PENDING_KEY = "patient_ngram_pending"
+
+# Rows inserted per statement while reindexing
+BATCH_SIZE = 5000
+
+
+def normalize(value):
+    return " ".join(unicodedata.normalize("NFC", value).lower().split())
+
+
+def ngrams(value, n):
+    return {value[i : i + n] for i in range(len(value) - n + 1)}
+
+
+def patient_grams(values):
+    """
+    Bigrams and trigrams of every searchable column of a patient
+    """
+
+    grams = set()
+
+    for column in NGRAM_COLUMNS:
+        if values.get(column):
+            value = normalize(values[column])
+
+            for n in NGRAM_SIZES:
+                grams.update(ngrams(value, n))
+
+    return grams
+
+
+def query_grams(query):
+    """
+    Grams every match contains, None when the query is too short
+    """
+
+    query = normalize(query)
+
+    if len(query) < NGRAM_SIZES[0]:
+        return None
+
+    return ngrams(query, min(len(query), NGRAM_SIZES[-1]))
+
+
+def gram_rows(patient_id, values):
+    return [
+        {"gram": gram, "patient_id": patient_id}
+        for gram in patient_grams(values)
+    ]
+
+
+@event.listens_for(db.session, "before_flush")
+def collect_ngram_changes(session, flush_context, instances):
+    """
+    Patients whose searchable columns are about to change
+    """
+
+    pending = session.info.setdefault(PENDING_KEY, set())
+
+    for obj in session.new:
+        if isinstance(obj, Patient):
+            pending.add(obj)
+
+    for obj in session.dirty:
+        if isinstance(obj, Patient):
+            attrs = inspect(obj).attrs
+
+            if any(attrs[c].history.has_changes() for c in NGRAM_COLUMNS):
+                pending.add(obj)
+
+
+@event.listens_for(db.session, "after_flush")
+def apply_ngram_changes(session, flush_context):
+    """
+    Rewrite the n-grams of the changed patients in the flush transaction
+    Deleted patients lose theirs with the foreign key cascade
+    """
+
+    pending = session.info.pop(PENDING_KEY, set())
+    patients = [p for p in pending if p.id is not None and p in session]
+
+    if not patients:
+        return
+
+    logger.debug("Indexing n-grams of {} patients.".format(len(patients)))
+
+    session.execute(
+        PatientNgram.__table__.delete().where(
+            PatientNgram.patient_id.in_([p.id for p in patients])
+        )
+    )
+    write_ngrams(
+        session,
+        [
+            (patient.id, {c: getattr(patient, c) for c in NGRAM_COLUMNS})
+            for patient in patients
+        ],
+    )
+
+
+def write_ngrams(session, patients):
+    """
+    Insert the n-grams of (patient id, column values) pairs
+    """
+
+    rows = []
+
+    for patient_id, values in patients:
+        rows.extend(gram_rows(patient_id, values))
+
+    if rows:
+        session.execute(PatientNgram.__table__.insert(), rows)
+
+
+def rebuild_ngrams(session):
+    """
+    Recompute the n-grams of every patient, backfills existing data
+    """
+
+    session.execute(text("LOCK TABLE patient_ngram IN EXCLUSIVE MODE"))
+    session.execute(PatientNgram.__table__.delete())
+
+    columns = [getattr(Patient, c) for c in NGRAM_COLUMNS]
+    query = session.query(Patient.id, *columns).yield_per(BATCH_SIZE)
+    rows = []
+    no_of_patients = 0
+
+    for row in query:
+        rows.extend(gram_rows(row[0], dict(zip(NGRAM_COLUMNS, row[1:]))))
+        no_of_patients += 1
+
+        if len(rows) >= BATCH_SIZE:
+            session.execute(PatientNgram.__table__.insert(), rows)
+            rows = []
+
+    if rows:
+        session.execute(PatientNgram.__table__.insert(), rows)
+
+    return no_of_patients
@@ -0,0 +1,107 @@
+"""
+Patient Overview
+Everything a chart opens with, read with a fixed number of statements that
+walk the (paitent_id, date) indexes whatever the length of the history
+"""
+
+from backend.app import db
+from backend.models import Visit, Lab, Imaging, Appointment
+from sqlalchemy import text
+from collections import OrderedDict
+import json
+
+# Latest value of each derived field, one LATERAL join each
+DERIVED_SQL = """
+    SELECT cd4.date AS cd4_date, cd4.cd4, cd4.p_cd4,
+        vl.date AS vl_date, vl.vl,
+        arv.date AS arv_date, arv.arv
+    FROM (SELECT CAST(:patient_id AS integer) AS id) AS patient
+    LEFT JOIN LATERAL (
+        SELECT date, cd4, p_cd4 FROM lab
+        WHERE paitent_id = patient.id AND cd4 IS NOT NULL
+        ORDER BY date DESC, id DESC LIMIT 1
+    ) AS cd4 ON true
+    LEFT JOIN LATERAL (
+        SELECT date, vl FROM lab
+        WHERE paitent_id = patient.id AND vl IS NOT NULL
+        ORDER BY date DESC, id DESC LIMIT 1
+    ) AS vl ON true
+    LEFT JOIN LATERAL (
+        SELECT date, arv FROM visit
+        WHERE paitent_id = patient.id
+            AND arv IS NOT NULL AND arv NOT IN ('null', '[]')
+        ORDER BY date DESC, id DESC LIMIT 1
+    ) AS arv ON true
+"""
+
+
+def latest(model, patient_id, limit):
+    return (
+        model.query.filter(model.paitent_id == patient_id)
+        .order_by(model.date.desc(), model.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+def upcoming(patient_id, today, limit):
+    return (
+        Appointment.query.filter(
+            Appointment.paitent_id == patient_id, Appointment.date >= today
+        )
+        .order_by(Appointment.date, Appointment.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def derived_values(patient_id):
+    """
+    Last CD4, last viral load and current ARV regimen, None when missing
+    """
+
+    row = db.session.execute(
+        text(DERIVED_SQL), {"patient_id": patient_id}
+    ).first()
+
+    derived = OrderedDict(
+        [("lastCd4", None), ("lastVl", None), ("currentArv", None)]
+    )
+
+    if row["cd4_date"] is not None:
+        derived["lastCd4"] = {
+            "date": row["cd4_date"],
+            "cd4": row["cd4"],
+            "p_cd4": row["p_cd4"],
+        }
+
+    if row["vl_date"] is not None:
+        derived["lastVl"] = {"date": row["vl_date"], "vl": row["vl"]}
+
+    if row["arv_date"] is not None:
+        derived["currentArv"] = {
+            "date": row["arv_date"],
+            "arv": json.loads(row["arv"]),
+        }
+
+    return derived
+
+
+def patient_overview(patient, today, limit):
+    """
+    Latest records of every child type, upcoming appointments and the
+    derived values of a patient
+    """
+
+    overview = OrderedDict(
+        [
+            ("patient", patient),
+            ("visits", latest(Visit, patient.id, limit)),
+            ("labs", latest(Lab, patient.id, limit)),
+            ("imaging", latest(Imaging, patient.id, limit)),
+            ("appointments", upcoming(patient.id, today, limit)),
+        ]
+    )
+    overview.update(derived_values(patient.id))
+
+    return overview
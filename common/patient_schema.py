@@ -0,0 +1,147 @@
+"""
+Form Schemas
+Arguments of the patient and child record forms, shared by the resources,
+the bulk import and the benchmark dataset
+"""
+
+from marshmallow import Schema, validate
+from webargs import fields
+
+# JSON Schema
+PATIENT_ARGS = {
+    "gov_id_type": fields.String(
+        validate=validate.OneOf(["บัตรประชาชน", "พาสปอร์ต"])
+    ),
+    "gov_id": fields.String(),
+    "name": fields.String(required=True),
+    "dob": fields.Date(),
+    "first_encounter": fields.Date(),
+    "sex": fields.String(
+        validate=validate.OneOf(["ชาย", "หญิง"]), required=True
+    ),
+    "gender": fields.String(
+        validate=validate.OneOf(
+            ["Male", "Female", "MSM", "Bisexual", "Lesbian", "TG"]
+        ),
+        required=True,
+    ),
+    "marital": fields.String(
+        validate.OneOf(["โสด", "สมรส", "หย่าร้าง", "ม่าย"])
+    ),
+    "nationality": fields.String(required=True),
+    "education": fields.String(
+        validate=validate.OneOf(
+            [
+                "ต่ำกว่ามัธยมศึกษาตอนปลาย",
+                "มัธยมศึกษาตอนปลาย",
+                "ปวช/ปวส",
+                "ปริญญาตรี",
+                "ปริญญาโท",
+                "ปริญญาเอก",
+            ]
+        )
+    ),
+    "address": fields.String(),
+    "tel": fields.List(fields.String(allow_missing=True)),
+    "relative_tel": fields.List(fields.String(allow_missing=True)),
+    "is_refer": fields.String(
+        required=True,
+        validate=validate.OneOf(
+            [
+                "ผู้ป่วยใหม่",
+                "ผู้ป่วยรับโอน (ยังไม่เริ่ม ARV)",
+                "ผู้ป่วยรับโอน (เริ่ม ARV แล้ว)",
+            ]
+        ),
+    ),
+    "refer_from": fields.String(),
+    "hn": fields.String(required=True),
+    "hiv_clinic_id": fields.String(),
+    "nap": fields.String(),
+    "bill_payer": fields.String(
+        required=True,
+        validate=validate.OneOf(
+            [
+                "ประกันสุขภาพทั่วหน้า",
+                "ประกันสุขภาพทั่วหน้า นอกเขต",
+                "ประกันสังคม",
+                "ประกันสังคม ต่างรพ.",
+                "ข้าราชการ/จ่ายตรง",
+                "ต่างด้าว",
+                "ชำระเงิน",
+            ]
+        ),
+    ),
+    "plans": fields.List(
+        fields.Nested(
+            {
+                "date": fields.Date(required=True),
+                "plan": fields.String(required=True),
+            },
+            allow_missing=True,
+        )
+    ),
+}
+
+VISIT_ARGS = {
+    "date": fields.Date(required=True),
+    "is_art_adherence": fields.String(validate=validate.OneOf(["Yes", "No"])),
+    "art_delay": fields.Float(),
+    "art_adherence_scale": fields.Float(),
+    "art_adherence_problem": fields.String(),
+    "hx_contact_tb": fields.String(),
+    "bw": fields.Float(),
+    "abn_pe": fields.List(fields.String(allow_missing=True)),
+    "imp": fields.List(fields.String(), validate=validate.Length(min=1)),
+    "arv": fields.List(fields.String(allow_missing=True)),
+    "why_switched_arv": fields.String(),
+    "oi_prophylaxis": fields.List(fields.String(allow_missing=True)),
+    "anti_tb": fields.List(fields.String(allow_missing=True)),
+    "vaccination": fields.List(fields.String(allow_missing=True)),
+}
+
+LAB_ARGS = {
+    "date": fields.Date(required=True),
+    "anti_hiv": fields.String(validate=validate.OneOf(["+", "-", "+/-"])),
+    "cd4": fields.Integer(),
+    "p_cd4": fields.Float(),
+    "vl": fields.Integer(),
+    "hiv_resistence": fields.String(),
+    "hbsag": fields.String(validate=validate.OneOf(["+", "-", "+/-"])),
+    "anti_hbs": fields.String(validate=validate.OneOf(["+", "-", "+/-"])),
+    "anti_hcv": fields.String(validate=validate.OneOf(["+", "-", "+/-"])),
+    "afb": fields.String(
+        validate=validate.OneOf(["3+", "2+", "1+", "Scantly", "-"])
+    ),
+    "sputum_gs": fields.String(),
+    "sputum_cs": fields.String(),
+    "genexpert": fields.String(),
+    "vdrl": fields.String(validate=validate.OneOf(["+", "-", "+/-"])),
+    "rpr": fields.String(validate=validate.Regexp(r"^1:\d+$")),
+}
+
+IMAGING_ARGS = {
+    "date": fields.Date(required=True),
+    "film_type": fields.String(required=True),
+    "result": fields.String(required=True),
+}
+
+APPOINTMENT_ARGS = {
+    "date": fields.Date(required=True),
+    "appointment_for": fields.String(required=True),
+}
+
+# Validates one imported row like PatientResource.form_data
+PatientSchema = type("PatientSchema", (Schema,), dict(PATIENT_ARGS))
+
+
+def choices(args, name):
+    """
+    Values accepted by the OneOf validator of a form field
+    """
+
+    for validator in args[name].validators:
+        if isinstance(validator, validate.OneOf):
+            return list(validator.choices)
+
+    raise KeyError("{} has no choices".format(name))
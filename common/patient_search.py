@@ -0,0 +1,198 @@
+"""
+Ranked Patient Search
+Full text search ordered by ts_rank and id, pages are fetched with a keyset
+cursor and the total is the planner estimate instead of an exact COUNT.
+Substring search goes through the patient n-gram index
+"""
+
+from backend.app import db
+from backend.common.patient_ngrams import NGRAM_COLUMNS, normalize, query_grams
+from sqlalchemy import text
+import binascii
+import base64
+import json
+
+# Same configuration as Patient.search_vector
+PATIENT_REGCONFIG = "pg_catalog.thai"
+
+# Columns of the search result label
+LABEL_COLUMNS = [
+    "hn",
+    "name",
+    "hiv_clinic_id",
+    "nationality",
+    "gov_id",
+    "nap",
+    "refer_from",
+]
+
+SEARCH_SQL = """
+    SELECT id, {columns},
+        ts_rank(search_vector, query)::float8 AS rank
+    FROM patient, tsq_parse(CAST(:regconfig AS regconfig), :query) AS query
+    WHERE search_vector @@ query {after}
+    ORDER BY ts_rank(search_vector, query) DESC, id
+    LIMIT :limit
+"""
+
+# Rows ranked after the cursor, ranks are compared as stored (real)
+AFTER_SQL = """
+    AND (
+        ts_rank(search_vector, query) < CAST(:rank AS real)
+        OR (ts_rank(search_vector, query) = CAST(:rank AS real)
+            AND id > :id)
+    )
+"""
+
+
+def encode_cursor(rank, row_id):
+    return (
+        base64.urlsafe_b64encode(json.dumps([rank, row_id]).encode())
+        .decode()
+        .rstrip("=")
+    )
+
+
+def decode_cursor(cursor):
+    """
+    (rank, id) of a cursor, raises ValueError when it is malformed
+    """
+
+    try:
+        rank, row_id = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Invalid cursor {}".format(cursor))
+
+    if not isinstance(rank, (int, float)) or not isinstance(row_id, int):
+        raise ValueError("Invalid cursor {}".format(cursor))
+
+    return rank, row_id
+
+
+def patient_label(row):
+    return (
+        "HN #{} - {} -- Clinic ID: {}, Nationality: {}"
+        ", ID/Passport: {}, NAP: {}, Referred From: {}"
+    ).format(*[row[c] for c in LABEL_COLUMNS])
+
+
+def estimated_matches(query):
+    """
+    Number of matching patients estimated by the planner
+    """
+
+    plan = db.session.execute(
+        text(
+            """
+            EXPLAIN (FORMAT JSON)
+            SELECT 1 FROM patient
+            WHERE search_vector
+                @@ tsq_parse(CAST(:regconfig AS regconfig), :query)
+            """
+        ),
+        {"regconfig": PATIENT_REGCONFIG, "query": query},
+    ).scalar()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def search_patients(query, limit, cursor=None):
+    """
+    One page of patients matching the query, only the label columns are
+    read. Returns the items and the cursor of the next page or None
+    """
+
+    params = {
+        "regconfig": PATIENT_REGCONFIG,
+        "query": query,
+        "limit": limit + 1,
+    }
+
+    if cursor is not None:
+        params["rank"], params["id"] = decode_cursor(cursor)
+
+    rows = db.session.execute(
+        text(
+            SEARCH_SQL.format(
+                columns=", ".join(LABEL_COLUMNS),
+                after=AFTER_SQL if cursor is not None else "",
+            )
+        ),
+        params,
+    ).fetchall()
+
+    items = [{"label": patient_label(row), "hn": row["hn"]} for row in rows]
+    next_cursor = None
+
+    if len(rows) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(
+            rows[limit - 1]["rank"], rows[limit - 1]["id"]
+        )
+
+    return items, next_cursor
+
+
+NGRAM_SQL = """
+    WITH candidate AS (
+        SELECT patient_id FROM patient_ngram
+        WHERE gram = ANY(:grams)
+        GROUP BY patient_id
+        HAVING count(*) = :no_of_grams
+    )
+    SELECT patient.id, {columns}, {prefix} AS prefix
+    FROM candidate JOIN patient ON patient.id = candidate.patient_id
+    WHERE {matches}
+    ORDER BY prefix DESC, patient.hn
+    LIMIT :limit
+"""
+
+
+# Same normalization as patient_ngrams.normalize
+NORMALIZED_COLUMN = (
+    "lower(regexp_replace(coalesce(patient.{}, ''), '\\s+', ' ', 'g'))"
+)
+
+
+def ngram_patients(query, limit):
+    """
+    Patients with the query anywhere in a searchable column, matches at
+    the start of a column first. Returns None when the query is too short
+    """
+
+    grams = query_grams(query)
+
+    if grams is None:
+        return None
+
+    columns = [NORMALIZED_COLUMN.format(c) for c in NGRAM_COLUMNS]
+
+    rows = db.session.execute(
+        text(
+            NGRAM_SQL.format(
+                columns=", ".join(
+                    "patient.{}".format(c) for c in LABEL_COLUMNS
+                ),
+                prefix=" OR ".join(
+                    "strpos({}, :query) = 1".format(c) for c in columns
+                ),
+                matches=" OR ".join(
+                    "strpos({}, :query) > 0".format(c) for c in columns
+                ),
+            )
+        ),
+        {
+            "grams": list(grams),
+            "no_of_grams": len(grams),
+            "query": normalize(query),
+            "limit": limit,
+        },
+    ).fetchall()
+
+    return [{"label": patient_label(row), "hn": row["hn"]} for row in rows]
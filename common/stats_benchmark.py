@@ -0,0 +1,392 @@
+"""
+Statistics Benchmark
+Seeded synthetic clinic dataset and timing of every statistics section,
+results are written as JSON so that runs can be compared between commits
+"""
+
+from backend.app import logger
+from backend.models import Patient, Visit, Lab
+from backend.common.stats_engine import StatsEngine, SECTIONS
+from backend.common.stats_counters import CounterStatsEngine
+from backend.common.stats_stream import StreamingStatsEngine
+from backend.common.json_encoder import CustomJSONEncoder
+from backend.common.patient_schema import PATIENT_ARGS, LAB_ARGS, choices
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+import subprocess
+import tracemalloc
+import platform
+import random
+import time
+import json
+
+# Dataset sizes, name -> number of patients
+DATASETS = OrderedDict([("1k", 1000), ("10k", 10000), ("100k", 100000)])
+
+# Engines compared by the benchmark
+ENGINES = OrderedDict(
+    [
+        ("sql", StatsEngine),
+        ("stream", StreamingStatsEngine),
+        ("counters", CounterStatsEngine),
+    ]
+)
+
+# Rows inserted per statement while seeding
+BATCH_SIZE = 5000
+
+
+def weighted(args, name, weights, missing=0):
+    """
+    Value -> weight over the choices of a form field, in the order of the
+    choices. None is a missing answer
+    """
+
+    values = choices(args, name)
+
+    if len(values) != len(weights):
+        raise ValueError("{} has {} choices".format(name, len(values)))
+
+    table = OrderedDict(zip(values, weights))
+
+    if missing:
+        table[None] = missing
+
+    return table
+
+
+# Realistic values of the form choices, value -> weight
+GOV_ID_TYPE = weighted(PATIENT_ARGS, "gov_id_type", [92, 8])
+SEX = weighted(PATIENT_ARGS, "sex", [62, 38])
+GENDER = weighted(PATIENT_ARGS, "gender", [45, 30, 15, 4, 2, 4])
+# Choices of the marital form field, which does not validate them
+MARITAL = {"โสด": 45, "สมรส": 35, "หย่าร้าง": 10, "ม่าย": 5, None: 5}
+NATIONALITY = {"ไทย": 87, "พม่า": 7, "ลาว": 3, "กัมพูชา": 3}
+EDUCATION = weighted(
+    PATIENT_ARGS, "education", [35, 25, 15, 17, 4, 1], missing=3
+)
+IS_REFER = weighted(PATIENT_ARGS, "is_refer", [68, 12, 20])
+NEW_PATIENT = choices(PATIENT_ARGS, "is_refer")[0]
+REFER_FROM = {
+    "โรงพยาบาลชุมชน": 40,
+    "คลินิกนิรนาม": 25,
+    "Private Hospital": 20,
+    "Prison": 5,
+    "NGO": 10,
+}
+BILL_PAYER = weighted(PATIENT_ARGS, "bill_payer", [45, 10, 25, 5, 8, 4, 3])
+
+IMPRESSIONS = {
+    "B20": 60,
+    "Z21": 25,
+    "A15.0": 5,
+    "B37.0": 4,
+    "B45.9": 2,
+    "B59": 2,
+    "E78.5": 4,
+    "I10": 6,
+}
+ARV_REGIMENS = {
+    ("TDF", "3TC", "EFV"): 45,
+    ("TDF", "FTC", "EFV"): 15,
+    ("TDF", "3TC", "DTG"): 15,
+    ("AZT", "3TC", "NVP"): 10,
+    ("AZT", "3TC", "LPV/r"): 5,
+    ("ABC", "3TC", "DTG"): 5,
+    (): 5,
+}
+OI_PROPHYLAXIS = {"Bactrim": 60, "Fluconazole": 25, "Dapsone": 15}
+ANTI_TB = {"INH": 40, "RIF": 20, "PZA": 15, "EMB": 15, "Levofloxacin": 10}
+VACCINATION = {"HBV": 40, "Influenza": 35, "บาดทะยัก": 15, "PCV13": 10}
+WHY_SWITCHED_ARV = {
+    "Side effects": 45,
+    "Treatment failure": 30,
+    "Drug interaction": 15,
+    "ตั้งครรภ์": 10,
+}
+
+ANTI_HIV = weighted(LAB_ARGS, "anti_hiv", [96, 2, 2])
+AFB = weighted(LAB_ARGS, "afb", [3, 3, 5, 4, 85])
+GENEXPERT = {
+    "MTB not detected": 85,
+    "MTB detected, RIF resistance not detected": 12,
+    "MTB detected, RIF resistance detected": 3,
+}
+
+
+class ClinicDataGenerator(object):
+    """
+    Deterministic generator of patients with their visits and labs
+    """
+
+    def __init__(
+        self,
+        seed=0,
+        visits_per_patient=10,
+        labs_per_patient=4,
+        years=10,
+        today=None,
+    ):
+        self.random = random.Random(seed)
+        self.visits_per_patient = visits_per_patient
+        self.labs_per_patient = labs_per_patient
+        self.today = today or date(2024, 1, 1)
+        self.start = self.today - timedelta(days=365 * years)
+
+    def choice(self, weights):
+        return self.random.choices(
+            list(weights.keys()), weights=list(weights.values())
+        )[0]
+
+    def sample(self, weights, k):
+        """
+        Up to k distinct weighted values, stored like a form list
+        """
+
+        return sorted(
+            {self.choice(weights) for _ in range(self.random.randint(0, k))}
+        )
+
+    def day_between(self, start, end):
+        return start + timedelta(
+            days=self.random.randint(0, max(0, (end - start).days))
+        )
+
+    def patient(self, no):
+        first_encounter = self.day_between(self.start, self.today)
+        is_refer = self.choice(IS_REFER)
+
+        return {
+            "hn": "BM{:07d}".format(no),
+            "hiv_clinic_id": "C{:07d}".format(no),
+            "gov_id_type": self.choice(GOV_ID_TYPE),
+            "gov_id": "{:013d}".format(no),
+            "name": "ผู้ป่วย ทดสอบ {}".format(no),
+            "dob": self.day_between(date(1940, 1, 1), first_encounter),
+            "first_encounter": first_encounter,
+            "sex": self.choice(SEX),
+            "gender": self.choice(GENDER),
+            "marital": self.choice(MARITAL),
+            "nationality": self.choice(NATIONALITY),
+            "education": self.choice(EDUCATION),
+            "is_refer": is_refer,
+            "refer_from": self.choice(REFER_FROM)
+            if is_refer != NEW_PATIENT
+            else None,
+            "bill_payer": self.choice(BILL_PAYER),
+            "tel": json.dumps(["08{:08d}".format(no)]),
+            "timestamp": datetime.utcnow(),
+            "modify_timestamp": datetime.utcnow(),
+        }
+
+    def visit(self, patient_id, first_encounter):
+        regimen = list(self.choice(ARV_REGIMENS))
+        visit = {
+            "date": self.day_between(first_encounter, self.today),
+            "is_art_adherence": "Yes" if regimen else "No",
+            "art_adherence_scale": round(self.random.uniform(80, 100), 1),
+            "bw": round(self.random.gauss(58, 10), 1),
+            "imp": [self.choice(IMPRESSIONS)] + self.sample(IMPRESSIONS, 1),
+            "arv": regimen,
+            "why_switched_arv": self.choice(WHY_SWITCHED_ARV)
+            if self.random.random() < 0.05
+            else None,
+            "oi_prophylaxis": self.sample(OI_PROPHYLAXIS, 1),
+            "anti_tb": self.sample(ANTI_TB, 4)
+            if self.random.random() < 0.08
+            else None,
+            "vaccination": self.sample(VACCINATION, 1),
+            "paitent_id": patient_id,
+            "timestamp": datetime.utcnow(),
+            "modify_timestamp": datetime.utcnow(),
+        }
+
+        return Visit.convert_to_json(visit)
+
+    def lab(self, patient_id, first_encounter):
+        # Viral load is skewed towards suppressed, stored like the form
+        # integer
+        vl = str(int(self.random.lognormvariate(4, 3)))
+
+        return {
+            "date": self.day_between(first_encounter, self.today),
+            "anti_hiv": self.choice(ANTI_HIV),
+            "cd4": max(0, int(self.random.gauss(450, 200))),
+            "p_cd4": round(self.random.uniform(5, 40), 1),
+            "vl": vl if self.random.random() < 0.8 else None,
+            "afb": self.choice(AFB) if self.random.random() < 0.2 else None,
+            "genexpert": self.choice(GENEXPERT)
+            if self.random.random() < 0.1
+            else None,
+            "paitent_id": patient_id,
+            "timestamp": datetime.utcnow(),
+            "modify_timestamp": datetime.utcnow(),
+        }
+
+    def children(self, patient_id, first_encounter, make, per_patient):
+        return [
+            make(patient_id, first_encounter)
+            for _ in range(self.random.randint(0, 2 * per_patient))
+        ]
+
+
+def seed_dataset(connection, patients, generator):
+    """
+    Insert the synthetic patients, visits and labs in batches
+    Returns the number of rows of each table
+    """
+
+    counts = OrderedDict([("patient", 0), ("visit", 0), ("lab", 0)])
+
+    for offset in range(0, patients, BATCH_SIZE):
+        patient_rows = [
+            generator.patient(no)
+            for no in range(offset, min(patients, offset + BATCH_SIZE))
+        ]
+        connection.execute(Patient.__table__.insert(), patient_rows)
+        ids = dict(
+            connection.execute(
+                Patient.__table__.select()
+                .with_only_columns(
+                    [Patient.__table__.c.hn, Patient.__table__.c.id]
+                )
+                .where(
+                    Patient.__table__.c.hn.in_(
+                        [row["hn"] for row in patient_rows]
+                    )
+                )
+            ).fetchall()
+        )
+
+        visit_rows = []
+        lab_rows = []
+
+        for row in patient_rows:
+            visit_rows.extend(
+                generator.children(
+                    ids[row["hn"]],
+                    row["first_encounter"],
+                    generator.visit,
+                    generator.visits_per_patient,
+                )
+            )
+            lab_rows.extend(
+                generator.children(
+                    ids[row["hn"]],
+                    row["first_encounter"],
+                    generator.lab,
+                    generator.labs_per_patient,
+                )
+            )
+
+        for table, rows in (
+            (Visit.__table__, visit_rows),
+            (Lab.__table__, lab_rows),
+        ):
+            for start in range(0, len(rows), BATCH_SIZE):
+                connection.execute(
+                    table.insert(), rows[start : start + BATCH_SIZE]
+                )
+
+        counts["patient"] += len(patient_rows)
+        counts["visit"] += len(visit_rows)
+        counts["lab"] += len(lab_rows)
+
+        logger.debug(
+            "Seeded {} patients, {} visits and {} labs.".format(
+                counts["patient"], counts["visit"], counts["lab"]
+            )
+        )
+
+    return counts
+
+
+def measure(function, repeat):
+    """
+    Best wall time of repeated calls, peak traced memory and the result
+    """
+
+    timings = []
+    peak = 0
+
+    for _ in range(repeat):
+        tracemalloc.start()
+        started = time.perf_counter()
+
+        try:
+            result = function()
+            timings.append(time.perf_counter() - started)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+
+        finally:
+            tracemalloc.stop()
+
+    return {"seconds": min(timings), "peak_bytes": peak}, result
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(engine, dataset, engines=None, sections=None, repeat=3):
+    """
+    Time every section of every engine, then its serialization
+    """
+
+    report = OrderedDict(
+        [
+            ("revision", git_revision()),
+            ("created", datetime.utcnow().isoformat()),
+            ("python", platform.python_version()),
+            ("dataset", dataset),
+            ("repeat", repeat),
+            ("results", []),
+        ]
+    )
+
+    for engine_name in engines or ENGINES.keys():
+        for section in sections or SECTIONS.keys():
+            with engine.connect() as connection:
+                stats_engine = ENGINES[engine_name](connection)
+                compute = getattr(stats_engine, "{}_stats".format(section))
+                timing, statistics = measure(compute, repeat)
+
+            serialization, body = measure(
+                lambda: json.dumps(statistics, cls=CustomJSONEncoder), repeat
+            )
+
+            report["results"].append(
+                OrderedDict(
+                    [
+                        ("engine", engine_name),
+                        ("section", section),
+                        ("seconds", round(timing["seconds"], 6)),
+                        ("peak_bytes", timing["peak_bytes"]),
+                        (
+                            "serialize_seconds",
+                            round(serialization["seconds"], 6),
+                        ),
+                        ("serialize_peak_bytes", serialization["peak_bytes"]),
+                        ("response_bytes", len(body.encode())),
+                    ]
+                )
+            )
+
+            logger.debug(
+                "Benchmark {} {}: {:.3f} s.".format(
+                    engine_name, section, timing["seconds"]
+                )
+            )
+
+    return report
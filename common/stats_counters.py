@@ -0,0 +1,585 @@
+"""
+Incrementally Maintained Statistics
+Counters in the stats_counter table are adjusted in the same transaction as
+the patient and visit writes, /api/stats then only reads the counters
+"""
+
+from backend.app import db, logger
+from backend.models import (
+    Patient,
+    Visit,
+    Lab,
+    Imaging,
+    Appointment,
+    StatsCounter,
+)
+from backend.common.stats_engine import (
+    StatsEngine,
+    SECTIONS,
+    AGE_STATISTICS,
+    PATIENT_DIMENSIONS,
+    PATIENT_COUNTS,
+    PATIENT_MONTHLY,
+    VISIT_LIST_COUNTS,
+    MISSING,
+    json_elements,
+    count_frame,
+    crosstab_frame,
+    age_statistics,
+    monthly_visit_frame,
+    element_frame,
+)
+from sqlalchemy import event, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.inspection import inspect
+from collections import Counter
+from datetime import date
+import pandas as pd
+import json
+
+# Patient columns counted by first encounter month
+COUNTER_DIMENSIONS = [d for d in PATIENT_DIMENSIONS if d != "first_encounter"]
+
+# Visit columns counted on every visit and on the latest visit only
+VISIT_ELEMENTS = ["vaccination", "imp"]
+LAST_VISIT_ELEMENTS = ["arv", "oi_prophylaxis", "anti_tb"]
+
+PENDING_KEY = "stats_counter_pending"
+
+# Advanced after every commit writing clinic data, versions cached statistics
+DATA_VERSION_SEQUENCE = "data_version_seq"
+VERSIONED_MODELS = (Patient, Visit, Lab, Imaging, Appointment)
+VERSION_KEY = "data_version_pending"
+
+
+def month(value):
+    if value is None:
+        return MISSING
+
+    return value.strftime("%Y-%m")
+
+
+def json_list(value):
+    try:
+        data = json.loads(value)
+
+    except (TypeError, ValueError):
+        return []
+
+    return data if isinstance(data, list) else []
+
+
+def patient_contributions(values):
+    """
+    Counter keys a patient row is counted in
+    """
+
+    period = month(values.get("first_encounter"))
+
+    for dimension in COUNTER_DIMENSIONS:
+        key = values.get(dimension)
+        yield ("patient." + dimension, period, MISSING if key is None else key)
+
+    if values.get("dob") is not None:
+        yield ("patient.dob", "", month(values["dob"]))
+
+
+def visit_contributions(values):
+    """
+    Counter keys a visit row is counted in
+    """
+
+    if values.get("imp") is not None and values["imp"] != "null":
+        yield ("visit.monthly", month(values.get("date")), "")
+
+    if values.get("why_switched_arv") is not None:
+        yield ("visit.why_switched_arv", "", values["why_switched_arv"])
+
+    for column in VISIT_ELEMENTS:
+        for element in json_list(values.get(column)):
+            yield ("visit." + column, "", str(element))
+
+
+def last_visit_contributions(values):
+    """
+    Counter keys the latest visit of a patient is counted in
+    """
+
+    if not values:
+        return
+
+    arv = json_list(values.get("arv"))
+
+    if arv:
+        yield ("last_visit.arv_regimen", "", ", ".join(map(str, arv)))
+
+    for column in LAST_VISIT_ELEMENTS:
+        for element in json_list(values.get(column)):
+            yield ("last_visit." + column, "", str(element))
+
+
+def current_values(obj, columns):
+    return {c: getattr(obj, c) for c in columns}
+
+
+def committed_values(obj, columns):
+    """
+    Column values as they are in the DB, before the pending changes
+    """
+
+    state = inspect(obj)
+    values = {}
+
+    for column in columns:
+        history = state.attrs[column].history
+
+        if history.deleted:
+            values[column] = history.deleted[0]
+
+        elif history.unchanged:
+            values[column] = history.unchanged[0]
+
+        else:
+            values[column] = getattr(obj, column)
+
+    return values
+
+
+def latest_visits(session, patient_ids):
+    """
+    Latest visit of each patient, keyed by patient id
+    """
+
+    if not patient_ids:
+        return {}
+
+    rows = session.execute(
+        text(
+            """
+            SELECT DISTINCT ON (paitent_id) paitent_id, {}
+            FROM visit
+            WHERE paitent_id = ANY(:patient_ids)
+            ORDER BY paitent_id, date DESC, id DESC
+            """.format(
+                ", ".join(LAST_VISIT_ELEMENTS)
+            )
+        ),
+        {"patient_ids": list(patient_ids)},
+    )
+
+    return {row["paitent_id"]: dict(row) for row in rows}
+
+
+# Model -> (contributions, columns read)
+CONTRIBUTIONS = {
+    Patient: (
+        patient_contributions,
+        COUNTER_DIMENSIONS + ["first_encounter", "dob"],
+    ),
+    Visit: (
+        visit_contributions,
+        ["date", "imp", "why_switched_arv"] + VISIT_ELEMENTS,
+    ),
+}
+
+
+@event.listens_for(db.session, "before_flush")
+def collect_counter_changes(session, flush_context, instances):
+    """
+    Compute counter deltas of the rows about to be written
+    """
+
+    deltas = Counter()
+    patients = set()
+
+    def count(obj, values, delta):
+        contributions, columns = CONTRIBUTIONS[type(obj)]
+
+        for contribution in contributions(values(obj, columns)):
+            deltas[contribution] += delta
+
+        if isinstance(obj, Visit):
+            patients.add(obj.patient_id)
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if type(obj) in CONTRIBUTIONS:
+                count(obj, current_values, 1)
+
+        for obj in session.dirty:
+            if type(obj) in CONTRIBUTIONS and session.is_modified(obj):
+                count(obj, committed_values, -1)
+                count(obj, current_values, 1)
+
+        for obj in session.deleted:
+            if type(obj) in CONTRIBUTIONS:
+                count(obj, committed_values, -1)
+
+            if isinstance(obj, Patient):
+                patients.add(obj)
+
+                # Visits are removed by the delete cascade
+                for visit in obj.visits:
+                    if visit not in session.deleted:
+                        count(visit, committed_values, -1)
+
+        for objs in (session.new, session.dirty, session.deleted):
+            if any(isinstance(obj, VERSIONED_MODELS) for obj in objs):
+                mark_data_written(session)
+
+        patients.discard(None)
+        previous = latest_visits(
+            session, [p.id for p in patients if p.id is not None]
+        )
+
+        for patient in patients:
+            for contribution in last_visit_contributions(
+                previous.get(patient.id)
+            ):
+                deltas[contribution] -= 1
+
+    session.info[PENDING_KEY] = (deltas, patients)
+
+
+@event.listens_for(db.session, "after_flush")
+def apply_counter_changes(session, flush_context):
+    """
+    Write counter deltas in the flush transaction
+    """
+
+    deltas, patients = session.info.pop(PENDING_KEY, (Counter(), set()))
+
+    current = latest_visits(
+        session, [p.id for p in patients if p.id is not None]
+    )
+
+    for patient in patients:
+        for contribution in last_visit_contributions(current.get(patient.id)):
+            deltas[contribution] += 1
+
+    write_counter_deltas(session, deltas)
+
+
+def write_counter_deltas(session, deltas):
+    """
+    Add the deltas to the counters, rows are created as needed
+    """
+
+    # Same lock order in every transaction, concurrent upserts can't deadlock
+    rows = [
+        {"statistic": s, "period": p, "key": k, "count": delta}
+        for (s, p, k), delta in sorted(deltas.items())
+        if delta
+    ]
+
+    if not rows:
+        return
+
+    logger.debug("Updating {} statistics counters.".format(len(rows)))
+
+    stmt = insert(StatsCounter.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["statistic", "period", "key"],
+        set_={"count": StatsCounter.__table__.c.count + stmt.excluded.count},
+    )
+    session.execute(stmt, rows)
+
+
+def rebuild_statements():
+    """
+    Set-based SQL recomputing every counter from the base tables
+    """
+
+    def coalesce(column):
+        return "COALESCE({}, '{}')".format(column, MISSING)
+
+    selects = []
+
+    for dimension in COUNTER_DIMENSIONS:
+        selects.append(
+            """
+            SELECT 'patient.{0}', {1}, {2}, count(*)
+            FROM patient GROUP BY 2, 3
+            """.format(
+                dimension,
+                coalesce("to_char(first_encounter, 'YYYY-MM')"),
+                coalesce(dimension),
+            )
+        )
+
+    selects.append(
+        """
+        SELECT 'patient.dob', '', to_char(dob, 'YYYY-MM'), count(*)
+        FROM patient WHERE dob IS NOT NULL GROUP BY 3
+        """
+    )
+    selects.append(
+        """
+        SELECT 'visit.monthly', to_char(date, 'YYYY-MM'), '', count(*)
+        FROM visit WHERE imp IS NOT NULL AND imp <> 'null' GROUP BY 2
+        """
+    )
+    selects.append(
+        """
+        SELECT 'visit.why_switched_arv', '', why_switched_arv, count(*)
+        FROM visit WHERE why_switched_arv IS NOT NULL GROUP BY 3
+        """
+    )
+
+    for column in VISIT_ELEMENTS:
+        selects.append(
+            """
+            SELECT 'visit.{0}', '', element, count(*)
+            FROM visit, {1} AS element GROUP BY 3
+            """.format(
+                column, json_elements(column)
+            )
+        )
+
+    selects.append(
+        """
+        SELECT 'last_visit.arv_regimen', '', regimen, count(*)
+        FROM (
+            SELECT NULLIF(array_to_string(ARRAY(SELECT {}), ', '), '')
+                AS regimen
+            FROM last_visit
+        ) AS regimens
+        WHERE regimen IS NOT NULL GROUP BY 3
+        """.format(
+            json_elements("arv")
+        )
+    )
+
+    for column in LAST_VISIT_ELEMENTS:
+        selects.append(
+            """
+            SELECT 'last_visit.{0}', '', element, count(*)
+            FROM last_visit, {1} AS element GROUP BY 3
+            """.format(
+                column, json_elements(column)
+            )
+        )
+
+    return [
+        "DELETE FROM stats_counter",
+        """
+        INSERT INTO stats_counter (statistic, period, key, count)
+        WITH last_visit AS (
+            SELECT DISTINCT ON (paitent_id) {columns}
+            FROM visit
+            ORDER BY paitent_id, date DESC, id DESC
+        )
+        {selects}
+        """.format(
+            columns=", ".join(LAST_VISIT_ELEMENTS),
+            selects=" UNION ALL ".join(selects),
+        ),
+    ]
+
+
+def rebuild_counters(session):
+    """
+    Recompute every counter from the base tables, fixes any drift
+    """
+
+    session.execute(text("LOCK TABLE stats_counter IN EXCLUSIVE MODE"))
+
+    for statement in rebuild_statements():
+        session.execute(text(statement))
+
+    mark_data_written(session)
+
+    return session.query(StatsCounter).count()
+
+
+def mark_data_written(session):
+    """
+    Advance the data version once the transaction commits
+    """
+
+    session.info[VERSION_KEY] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def bump_data_version(session):
+    """
+    Invalidate the statistics cached by every worker
+    A sequence is not a locked row and, bumped after the commit, a reader
+    never caches the old data under the new version
+    """
+
+    if session.info.pop(VERSION_KEY, False):
+        db.engine.execute(
+            text("SELECT nextval('{}')".format(DATA_VERSION_SEQUENCE))
+        )
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_data_version(session):
+    session.info.pop(VERSION_KEY, None)
+
+
+def data_version(bind):
+    """
+    Current version of the clinic data, a read of the sequence
+    last_value is the start value until the first nextval, which returns it
+    """
+
+    return bind.execute(
+        text(
+            "SELECT CASE WHEN is_called THEN last_value ELSE 0 END "
+            "FROM {}".format(DATA_VERSION_SEQUENCE)
+        )
+    ).scalar()
+
+
+def counter_statistics(statistics):
+    """
+    Counter names read for the requested statistics
+    """
+
+    names = []
+
+    for key in statistics:
+        if key in AGE_STATISTICS:
+            names.append("patient.dob")
+
+        elif key in PATIENT_MONTHLY:
+            names.append("patient." + PATIENT_MONTHLY[key])
+
+        elif key in PATIENT_COUNTS:
+            dimension = PATIENT_COUNTS[key][0]
+
+            if dimension == "first_encounter":
+                dimension = COUNTER_DIMENSIONS[0]
+
+            names.append("patient." + dimension)
+
+        elif key in VISIT_LIST_COUNTS:
+            column, _, last_visit = VISIT_LIST_COUNTS[key]
+            names.append(("last_visit." if last_visit else "visit.") + column)
+
+        elif key == "count_arv_regimen":
+            names.append("last_visit.arv_regimen")
+
+        elif key == "count_why_switched_arv":
+            names.append("visit.why_switched_arv")
+
+        elif key == "count_monthly_visit":
+            names.append("visit.monthly")
+
+    return names
+
+
+class CounterStatsEngine(StatsEngine):
+    """
+    Serve clinic statistics from the stats_counter table
+    """
+
+    def counters(self, names):
+        return self.read_sql(
+            """
+            SELECT statistic, period, key, count
+            FROM stats_counter
+            WHERE statistic = ANY(:names) AND count > 0
+            ORDER BY statistic, count DESC, key
+            """,
+            source="counters",
+            names=list(set(names)),
+        )
+
+    def patient_stats(self, statistics=None):
+        statistics = statistics or SECTIONS["patient"]
+        df = self.counters(counter_statistics(statistics))
+
+        if df.empty:
+            return {}
+
+        def rows(dimension):
+            dimension_df = df[df["statistic"] == "patient." + dimension]
+            return dimension_df.rename(
+                columns={"period": "first_encounter", "key": dimension}
+            )
+
+        results = {}
+
+        # Demographics Data
+        # No of patient by age group
+        if any(key in AGE_STATISTICS for key in statistics):
+            dob_df = rows("dob")
+            today = date.today()
+            dob = pd.to_datetime(dob_df["dob"], format="%Y-%m")
+            age_months = (
+                (today.year - dob.dt.year) * 12 + today.month - dob.dt.month
+            )
+            results.update(
+                age_statistics(age_months.values, dob_df["count"].values)
+            )
+
+        # Monthly Stats
+        for key, dimension in PATIENT_MONTHLY.items():
+            if key in statistics:
+                results[key] = crosstab_frame(rows(dimension), dimension)
+
+        # Overall Stats
+        for key, (dimension, output_column_name) in PATIENT_COUNTS.items():
+            if key not in statistics:
+                continue
+
+            if dimension == "first_encounter":
+                dimension_df = rows(COUNTER_DIMENSIONS[0])
+
+            else:
+                dimension_df = rows(dimension)
+
+            dimension_df = dimension_df.groupby(dimension, as_index=False)[
+                "count"
+            ].sum()
+            results[key] = count_frame(
+                dimension_df, dimension, output_column_name
+            )
+
+        return {k: v for k, v in results.items() if k in statistics}
+
+    def visit_stats(self, statistics=None):
+        statistics = statistics or SECTIONS["visit"]
+        df = self.counters(counter_statistics(statistics) + ["visit.monthly"])
+        monthly_df = df[df["statistic"] == "visit.monthly"]
+
+        if monthly_df.empty:
+            return {}
+
+        def rows(statistic):
+            return df[df["statistic"] == statistic]
+
+        results = {}
+
+        # Monthly Stats
+        if "count_monthly_visit" in statistics:
+            results["count_monthly_visit"] = monthly_visit_frame(
+                monthly_df["period"], monthly_df["count"].values
+            )
+
+        # Overall Stats
+        if "count_arv_regimen" in statistics:
+            results["count_arv_regimen"] = count_frame(
+                rows("last_visit.arv_regimen"), "key", "ARV Regimens"
+            )
+
+        if "count_why_switched_arv" in statistics:
+            results["count_why_switched_arv"] = count_frame(
+                rows("visit.why_switched_arv"),
+                "key",
+                "Why Change ARV Regimens",
+            ).fillna(MISSING)
+
+        for key, (column, name, last_visit) in VISIT_LIST_COUNTS.items():
+            if key in statistics:
+                key_df = rows(
+                    ("last_visit." if last_visit else "visit.") + column
+                )
+                results[key] = element_frame(
+                    key_df["key"].values, key_df["count"].values, name
+                )
+
+        return results
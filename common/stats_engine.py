@@ -0,0 +1,809 @@
+"""
+SQL Aggregation Engine for Clinic Statistics
+Grouping, crosstabs and "last visit per patient" are computed by PostgreSQL,
+only the aggregated rows are sent back to the worker
+"""
+
+from backend.app import logger
+from collections import OrderedDict
+from sqlalchemy import text
+import pandas as pd
+import numpy as np
+
+MISSING = "Missing/None"
+
+# Patient dimensions, column name -> SQL expression
+PATIENT_DIMENSIONS = OrderedDict(
+    [
+        (
+            "first_encounter",
+            "to_char(date_trunc(:granularity, first_encounter), "
+            ":period_format)",
+        ),
+        ("education", "education"),
+        ("nationality", "nationality"),
+        ("sex", "sex"),
+        ("gender", "gender"),
+        ("marital", "marital"),
+        ("is_refer", "is_refer"),
+        ("refer_from", "refer_from"),
+        ("bill_payer", "bill_payer"),
+    ]
+)
+
+# Overall counts, statistic -> (dimension, output column name)
+PATIENT_COUNTS = OrderedDict(
+    [
+        (
+            "count_first_encounter",
+            ("first_encounter", "เข้ารับการรักษาครั้งแรก"),
+        ),
+        ("count_education", ("education", "Education Level")),
+        ("count_nationality", ("nationality", "Nationality")),
+        ("count_sex", ("sex", "Sex")),
+        ("count_gender", ("gender", "Gender")),
+        ("count_marital", ("marital", "Marital Status")),
+        ("count_is_refer", ("is_refer", "Referral Status")),
+        ("count_refer_from", ("refer_from", "Referred From")),
+        ("count_bill_payer", ("bill_payer", "สิทธิ์การรักษา")),
+    ]
+)
+
+# Monthly crosstabs, statistic -> dimension
+PATIENT_MONTHLY = OrderedDict(
+    [
+        ("monthly_sex", "sex"),
+        ("monthly_gender", "nationality"),
+        ("monthly_is_refer", "is_refer"),
+        ("monthly_refer_from", "refer_from"),
+        ("monthly_bill_payer", "bill_payer"),
+    ]
+)
+
+# Visit list columns, statistic -> (column, output column name, last visit)
+VISIT_LIST_COUNTS = OrderedDict(
+    [
+        ("count_arv_breakdown", ("arv", "ARV Breakdown", True)),
+        ("count_oi_prophylaxis", ("oi_prophylaxis", "OI Prophylaxis", True)),
+        ("count_anti_tb", ("anti_tb", "Anti_TB Medications", True)),
+        ("count_vaccination", ("vaccination", "Vaccines", False)),
+        ("count_imp", ("imp", "Impressions", False)),
+    ]
+)
+
+# Granularity -> (interval, period format, visit label format)
+GRANULARITIES = OrderedDict(
+    [
+        ("day", ("1 day", "YYYY-MM-DD", "DD/MM/YYYY")),
+        ("week", ("1 week", 'IYYY-"W"IW', "DD/MM/YYYY")),
+        ("month", ("1 month", "YYYY-MM", "MM/YYYY")),
+        ("quarter", ("3 months", 'YYYY-"Q"Q', '"Q"Q/YYYY')),
+        ("year", ("1 year", "YYYY", "YYYY")),
+    ]
+)
+
+LAB_STATISTICS = [
+    "count_vl_suppression",
+    "monthly_vl_suppression",
+    "count_cd4",
+    "monthly_tb_positivity",
+]
+
+# Latest viral load, copies/mL
+VL_BINS = [-np.inf, 50, 1000, np.inf]
+VL_BANDS = [
+    "Undetectable (<50)",
+    "Suppressed (50-999)",
+    "Not Suppressed (>=1000)",
+]
+VL_SUPPRESSED = 1000
+
+# Latest CD4, cells/mm3
+CD4_BINS = [-np.inf, 200, 350, 500, np.inf]
+CD4_BANDS = ["<200", "200-349", "350-499", ">=500"]
+
+# Positive AFB smear grades, GeneXpert results are free text
+AFB_POSITIVE = ["3+", "2+", "1+", "Scantly"]
+GENEXPERT_POSITIVE = r"^\s*\+|positive|(?<!not )detected"
+
+AGE_STATISTICS = ["count_age_less_than_one", "count_age"]
+
+# Statistics served by each section of /api/stats
+SECTIONS = OrderedDict(
+    [
+        (
+            "patient",
+            AGE_STATISTICS
+            + list(PATIENT_MONTHLY.keys())
+            + list(PATIENT_COUNTS.keys()),
+        ),
+        (
+            "visit",
+            [
+                "count_monthly_visit",
+                "count_arv_regimen",
+                "count_why_switched_arv",
+            ]
+            + list(VISIT_LIST_COUNTS.keys()),
+        ),
+        ("lab", LAB_STATISTICS),
+    ]
+)
+
+AGE_MONTHS_SQL = (
+    "((EXTRACT(YEAR FROM current_date) - EXTRACT(YEAR FROM dob)) * 12"
+    " + EXTRACT(MONTH FROM current_date) - EXTRACT(MONTH FROM dob))::integer"
+)
+
+
+def json_elements(column):
+    """
+    SQL expression expanding a JSON list stored as text into its elements
+    """
+
+    return (
+        "json_array_elements_text(CASE WHEN json_typeof({0}::json) = 'array'"
+        " THEN {0}::json ELSE '[]'::json END)"
+    ).format(column)
+
+
+def grouping_mask(dimensions, grouping_set):
+    """
+    Value of GROUPING(<dimensions>) for the rows of a grouping set
+    """
+
+    mask = 0
+
+    for position, dimension in enumerate(dimensions):
+        if dimension not in grouping_set:
+            mask |= 1 << (len(dimensions) - 1 - position)
+
+    return mask
+
+
+def count_frame(df, column, output_column_name):
+    """
+    Two columns count table, same shape as a pandas groupby count
+    """
+
+    count_df = df[[column, "count"]].sort_values(column)
+    count_df.columns = [output_column_name, "Count"]
+    count_df.replace(r"^\s*$", np.nan, regex=True, inplace=True)
+
+    return count_df.reset_index(drop=True)
+
+
+def crosstab_frame(df, column):
+    """
+    Monthly crosstab with margins, same shape as pd.crosstab
+    """
+
+    table = (
+        df.pivot_table(
+            index="first_encounter",
+            columns=column,
+            values="count",
+            aggfunc="sum",
+            fill_value=0,
+            margins=True,
+            margins_name="All",
+        )
+        .fillna(0)
+        .astype(int)
+        .reset_index()
+    )
+    table.rename(columns={"first_encounter": "First Encounter"}, inplace=True)
+
+    return table
+
+
+def binned_frame(values, counts, bins, output_column_name):
+    """
+    Sum pre-aggregated counts into right-closed bins
+    """
+
+    if len(bins) < 2:
+        return pd.DataFrame(columns=[output_column_name, "Count"])
+
+    intervals = pd.cut(values, bins)
+    codes = np.asarray(intervals.codes)
+    in_range = codes >= 0
+    binned = np.bincount(
+        codes[in_range],
+        weights=np.asarray(counts)[in_range],
+        minlength=len(bins) - 1,
+    )
+
+    return pd.DataFrame(
+        {
+            output_column_name: list(intervals.categories),
+            "Count": binned.astype(int),
+        },
+        columns=[output_column_name, "Count"],
+    )
+
+
+def age_statistics(age_months, counts):
+    """
+    Age group tables from patient counts by age in months
+    """
+
+    statistics = {}
+
+    # less than one
+    statistics["count_age_less_than_one"] = binned_frame(
+        age_months, counts, np.arange(0, 13), "Age-Years"
+    )
+
+    # more than one
+    age_years = np.asarray(age_months) / 12
+    statistics["count_age"] = binned_frame(
+        age_years,
+        counts,
+        np.arange(0, (age_years.max() if len(age_years) else 0) + 1, 10),
+        "Age-Years",
+    )
+
+    return statistics
+
+
+def monthly_visit_frame(months, counts):
+    """
+    Number of visits per month, months without visit are filled with 0
+    """
+
+    months = pd.PeriodIndex(pd.to_datetime(months), freq="M")
+    monthly_count = (
+        pd.Series(counts, index=months)
+        .groupby(level=0)
+        .sum()
+        .reindex(pd.period_range(months.min(), months.max(), freq="M"))
+        .fillna(0)
+        .astype(int)
+    )
+
+    return pd.DataFrame(
+        {
+            "Month/Year": monthly_count.index.strftime("%m/%Y"),
+            "Number of Visit": monthly_count.values,
+        },
+        columns=["Month/Year", "Number of Visit"],
+    )
+
+
+def element_frame(elements, counts, output_column_name):
+    """
+    Count table of the elements found in JSON list columns
+    """
+
+    return pd.DataFrame(
+        {output_column_name: elements, "Count": counts},
+        columns=[output_column_name, "Count"],
+    )
+
+
+def viral_load(series):
+    """
+    Numeric viral load, "<40" like results count as undetectable
+    """
+
+    text = series.dropna().astype(str).str.strip()
+    copies = pd.to_numeric(
+        text.str.lstrip("<").str.replace(",", ""), errors="coerce"
+    )
+    copies[text.str.startswith("<")] = 0
+
+    return copies.reindex(series.index)
+
+
+def latest_per_patient(df, column, by=("paitent_id",)):
+    """
+    Latest tested row of each patient, df is sorted by patient and date
+    """
+
+    return df[df[column].notna()].drop_duplicates(subset=list(by), keep="last")
+
+
+def band_frame(values, bins, labels, output_column_name):
+    """
+    Count table of values cut into left-closed bands
+    """
+
+    counts = (
+        pd.cut(values, bins, right=False, labels=labels)
+        .value_counts(sort=False)
+        .reindex(labels, fill_value=0)
+    )
+
+    return pd.DataFrame(
+        {output_column_name: labels, "Count": counts.values.astype(int)},
+        columns=[output_column_name, "Count"],
+    )
+
+
+def positivity(df, column, is_positive, name):
+    """
+    Tested, positive and positivity rate per period
+    """
+
+    latest = latest_per_patient(df, column, by=("paitent_id", "bucket"))
+    grouped = latest.assign(positive=is_positive(latest[column])).groupby(
+        ["bucket", "label"], observed=True
+    )["positive"]
+
+    return pd.DataFrame(
+        {
+            "{} Tested".format(name): grouped.size(),
+            "{} Positive".format(name): grouped.sum().astype(int),
+            "{} Positivity (%)".format(name): (grouped.mean() * 100).round(1),
+        },
+        columns=[
+            "{} Tested".format(name),
+            "{} Positive".format(name),
+            "{} Positivity (%)".format(name),
+        ],
+    )
+
+
+def grouping_sets(statistics):
+    """
+    Patient grouping sets needed for the requested statistics
+    """
+
+    sets = []
+
+    for key in statistics:
+        if key in AGE_STATISTICS:
+            grouping_set = ("age_months",)
+
+        elif key in PATIENT_MONTHLY:
+            grouping_set = ("first_encounter", PATIENT_MONTHLY[key])
+
+        else:
+            grouping_set = (PATIENT_COUNTS[key][0],)
+
+        if grouping_set not in sets:
+            sets.append(grouping_set)
+
+    return sets
+
+
+def resolve_sections(names=None):
+    """
+    Map requested section or statistic names to {section: [statistics]}
+    """
+
+    requested = OrderedDict()
+
+    for name in names or SECTIONS:
+        if name in SECTIONS:
+            section, statistics = name, SECTIONS[name]
+
+        else:
+            section = next(
+                (s for s, keys in SECTIONS.items() if name in keys), None
+            )
+
+            if section is None:
+                raise KeyError(name)
+
+            statistics = [name]
+
+        keys = requested.setdefault(section, [])
+        keys.extend(k for k in statistics if k not in keys)
+
+    return requested
+
+
+class StatsEngine(object):
+    """
+    Compute clinic statistics with SQL aggregation
+    """
+
+    def __init__(
+        self, bind, date_from=None, date_to=None, granularity="month"
+    ):
+        self.bind = bind
+
+        step, period_format, label_format = GRANULARITIES[granularity]
+        self.params = {
+            "date_from": date_from,
+            "date_to": date_to,
+            "granularity": granularity,
+            "step": step,
+            "period_format": period_format,
+            "label_format": label_format,
+        }
+
+    def read_sql(self, sql, source="stats", categorical=(), **params):
+        """
+        Load a frame, repeated strings are stored as Categorical
+        """
+
+        df = pd.read_sql(
+            text(sql), self.bind, params=dict(self.params, **params)
+        )
+
+        for column in categorical:
+            if column in df:
+                df[column] = df[column].astype("category")
+
+        logger.debug(
+            "Statistics {}: loaded {} rows, {} bytes.".format(
+                source, len(df), df.memory_usage(deep=True).sum()
+            )
+        )
+
+        return df
+
+    def where(self, column, *conditions):
+        """
+        WHERE clause with the date range pushed down on column
+        """
+
+        conditions = list(conditions)
+
+        if self.params["date_from"] is not None:
+            conditions.append("{} >= :date_from".format(column))
+
+        if self.params["date_to"] is not None:
+            conditions.append("{} <= :date_to".format(column))
+
+        if not conditions:
+            return ""
+
+        return "WHERE " + " AND ".join(conditions)
+
+    def patient_stats(self, statistics=None):
+        """
+        Demographics statistics, one scan of the patient table
+        """
+
+        statistics = statistics or SECTIONS["patient"]
+        sets = grouping_sets(statistics)
+        dimensions = [
+            d
+            for d in list(PATIENT_DIMENSIONS.keys()) + ["age_months"]
+            if any(d in s for s in sets)
+        ]
+
+        columns = [
+            "COALESCE({}, '{}') AS {}".format(expr, MISSING, name)
+            for name, expr in PATIENT_DIMENSIONS.items()
+            if name in dimensions
+        ]
+
+        if "age_months" in dimensions:
+            columns.append("{} AS age_months".format(AGE_MONTHS_SQL))
+
+        df = self.read_sql(
+            """
+            SELECT {dimensions},
+                GROUPING({dimensions}) AS grouping_id,
+                count(*) AS count
+            FROM (SELECT {columns} FROM patient {where}) AS p
+            GROUP BY GROUPING SETS ({grouping_sets})
+            """.format(
+                dimensions=", ".join(dimensions),
+                columns=", ".join(columns),
+                where=self.where("first_encounter"),
+                grouping_sets=", ".join(
+                    "({})".format(", ".join(s)) for s in sets
+                ),
+            ),
+            source="patient",
+        )
+
+        if df.empty:
+            return {}
+
+        def rows(grouping_set):
+            mask = grouping_mask(dimensions, grouping_set)
+            return df[df["grouping_id"] == mask]
+
+        results = {}
+
+        # Demographics Data
+        # No of patient by age group
+        if ("age_months",) in sets:
+            age_df = rows(("age_months",)).dropna(subset=["age_months"])
+            results.update(
+                age_statistics(
+                    age_df["age_months"].values, age_df["count"].values
+                )
+            )
+
+        # Monthly Stats
+        for key, dimension in PATIENT_MONTHLY.items():
+            if key in statistics:
+                results[key] = crosstab_frame(
+                    rows(("first_encounter", dimension)), dimension
+                )
+
+        # Overall Stats
+        for key, (dimension, output_column_name) in PATIENT_COUNTS.items():
+            if key in statistics:
+                results[key] = count_frame(
+                    rows((dimension,)), dimension, output_column_name
+                )
+
+        return {k: v for k, v in results.items() if k in statistics}
+
+    def visit_stats(self, statistics=None):
+        """
+        Visit statistics, the latest visit is selected with DISTINCT ON
+        """
+
+        statistics = statistics or SECTIONS["visit"]
+        results = {}
+
+        # Monthly Stats
+        if "count_monthly_visit" in statistics:
+            monthly_df = self.read_sql(
+                """
+                WITH counts AS (
+                    SELECT date_trunc(:granularity, date::timestamp)
+                            AS bucket,
+                        count(*) FILTER (
+                            WHERE imp IS NOT NULL AND imp <> 'null'
+                        ) AS count
+                    FROM visit
+                    {where}
+                    GROUP BY 1
+                )
+                SELECT to_char(bucket, :label_format) AS label,
+                    COALESCE(counts.count, 0) AS count
+                FROM generate_series(
+                    (SELECT min(bucket) FROM counts),
+                    (SELECT max(bucket) FROM counts),
+                    CAST(:step AS interval)
+                ) AS bucket
+                LEFT JOIN counts USING (bucket)
+                ORDER BY bucket
+                """.format(
+                    where=self.where("date")
+                ),
+                source="visit",
+            )
+
+        else:
+            monthly_df = self.read_sql(
+                "SELECT 1 AS count FROM visit {} LIMIT 1".format(
+                    self.where("date")
+                ),
+                source="visit",
+            )
+
+        if monthly_df.empty:
+            return {}
+
+        if "count_monthly_visit" in statistics:
+            results["count_monthly_visit"] = pd.DataFrame(
+                {
+                    "Month/Year": monthly_df["label"].values,
+                    "Number of Visit": monthly_df["count"].values,
+                },
+                columns=["Month/Year", "Number of Visit"],
+            )
+
+        # Overall Stats
+        # Current ARV Regimens
+        if "count_arv_regimen" in statistics:
+            regimen_df = self.read_sql(
+                """
+                SELECT regimen, count(*) AS count
+                FROM (
+                    SELECT DISTINCT ON (paitent_id)
+                        NULLIF(
+                            array_to_string(ARRAY(SELECT {elements}), ', '), ''
+                        ) AS regimen
+                    FROM visit
+                    {where}
+                    ORDER BY paitent_id, date DESC, id DESC
+                ) AS last_visit
+                WHERE regimen IS NOT NULL
+                GROUP BY regimen
+                """.format(
+                    elements=json_elements("arv"), where=self.where("date")
+                ),
+                source="visit",
+            )
+            results["count_arv_regimen"] = count_frame(
+                regimen_df, "regimen", "ARV Regimens"
+            )
+
+        # Switching ARV?
+        if "count_why_switched_arv" in statistics:
+            why_switched_df = self.read_sql(
+                """
+                SELECT why_switched_arv, count(*) AS count
+                FROM visit
+                {where}
+                GROUP BY why_switched_arv
+                """.format(
+                    where=self.where("date", "why_switched_arv IS NOT NULL")
+                ),
+                source="visit",
+            )
+            results["count_why_switched_arv"] = count_frame(
+                why_switched_df, "why_switched_arv", "Why Change ARV Regimens"
+            ).fillna(MISSING)
+
+        # OI, Anti TB, ARV Breakdown, Vaccination and Impressions
+        list_counts = [
+            (key, spec)
+            for key, spec in VISIT_LIST_COUNTS.items()
+            if key in statistics
+        ]
+
+        if not list_counts:
+            return results
+
+        selects = []
+
+        for key, (column, _, last_visit) in list_counts:
+            selects.append(
+                """
+                SELECT '{key}' AS statistic, element, count(*) AS count
+                FROM {source}, {elements} AS element
+                {where}
+                GROUP BY element
+                """.format(
+                    key=key,
+                    source="last_visit" if last_visit else "visit",
+                    elements=json_elements(column),
+                    where="" if last_visit else self.where("date"),
+                )
+            )
+
+        last_visit_columns = [
+            column for _, (column, _, last_visit) in list_counts if last_visit
+        ]
+        list_df = self.read_sql(
+            """
+            WITH last_visit AS (
+                SELECT DISTINCT ON (paitent_id) paitent_id{columns}
+                FROM visit
+                {where}
+                ORDER BY paitent_id, date DESC, id DESC
+            )
+            {selects}
+            ORDER BY statistic, count DESC, element
+            """.format(
+                columns="".join(", " + c for c in last_visit_columns),
+                where=self.where("date"),
+                selects=" UNION ALL ".join(selects),
+            ),
+            source="visit",
+            categorical=["statistic"],
+        )
+
+        for key, (_, output_column_name, _) in list_counts:
+            key_df = list_df[list_df["statistic"] == key]
+            results[key] = element_frame(
+                key_df["element"].values,
+                key_df["count"].values,
+                output_column_name,
+            )
+
+        return results
+
+    def lab_stats(self, statistics=None):
+        """
+        Lab statistics on the latest result of each patient
+        Only the columns of the requested statistics are loaded
+        """
+
+        statistics = statistics or SECTIONS["lab"]
+        columns = []
+
+        if {"count_vl_suppression", "monthly_vl_suppression"} & set(
+            statistics
+        ):
+            columns.append("vl")
+
+        if "count_cd4" in statistics:
+            columns.append("cd4")
+
+        if "monthly_tb_positivity" in statistics:
+            columns.extend(["afb", "genexpert"])
+
+        lab_df = self.read_sql(
+            """
+            SELECT paitent_id,
+                date_trunc(:granularity, date::timestamp) AS bucket,
+                to_char(date_trunc(:granularity, date::timestamp),
+                    :label_format) AS label,
+                {columns}
+            FROM lab
+            {where}
+            ORDER BY paitent_id, date, id
+            """.format(
+                columns=", ".join(columns),
+                where=self.where(
+                    "date",
+                    "({})".format(
+                        " OR ".join(
+                            "{} IS NOT NULL".format(c) for c in columns
+                        )
+                    ),
+                ),
+            ),
+            source="lab",
+            categorical=["label", "afb", "genexpert"],
+        )
+
+        if lab_df.empty:
+            return {}
+
+        results = {}
+
+        # Viral Load
+        if "vl" in columns:
+            lab_df["vl"] = viral_load(lab_df["vl"])
+
+        if "count_vl_suppression" in statistics:
+            results["count_vl_suppression"] = band_frame(
+                latest_per_patient(lab_df, "vl")["vl"],
+                VL_BINS,
+                VL_BANDS,
+                "Viral Load (copies/mL)",
+            )
+
+        if "monthly_vl_suppression" in statistics:
+            latest = latest_per_patient(
+                lab_df, "vl", by=("paitent_id", "bucket")
+            )
+            grouped = latest.assign(
+                suppressed=latest["vl"] < VL_SUPPRESSED
+            ).groupby(["bucket", "label"], observed=True)["suppressed"]
+            monthly_df = pd.DataFrame(
+                {
+                    "Tested": grouped.size(),
+                    "Suppressed": grouped.sum().astype(int),
+                    "Suppression Rate (%)": (grouped.mean() * 100).round(1),
+                },
+                columns=["Tested", "Suppressed", "Suppression Rate (%)"],
+            ).reset_index(level="label")
+            monthly_df.rename(columns={"label": "Month/Year"}, inplace=True)
+            results["monthly_vl_suppression"] = monthly_df.reset_index(
+                drop=True
+            )
+
+        # CD4
+        if "count_cd4" in statistics:
+            results["count_cd4"] = band_frame(
+                latest_per_patient(lab_df, "cd4")["cd4"],
+                CD4_BINS,
+                CD4_BANDS,
+                "CD4 (cells/mm3)",
+            )
+
+        # TB, AFB and GeneXpert
+        if "monthly_tb_positivity" in statistics:
+            tb_df = pd.concat(
+                [
+                    positivity(
+                        lab_df, "afb", lambda s: s.isin(AFB_POSITIVE), "AFB"
+                    ),
+                    positivity(
+                        lab_df,
+                        "genexpert",
+                        lambda s: s.str.lower().str.contains(
+                            GENEXPERT_POSITIVE
+                        ),
+                        "GeneXpert",
+                    ),
+                ],
+                axis=1,
+            ).fillna(0)
+
+            for column in tb_df.columns:
+                if not column.endswith("(%)"):
+                    tb_df[column] = tb_df[column].astype(int)
+
+            tb_df = tb_df.sort_index().reset_index(level="label")
+            tb_df.rename(columns={"label": "Month/Year"}, inplace=True)
+            results["monthly_tb_positivity"] = tb_df.reset_index(drop=True)
+
+        return results
@@ -0,0 +1,127 @@
+"""
+Concurrent Statistics Executor
+Run independent statistics sections on a bounded thread pool, every task
+uses its own connection reading the same exported snapshot. Tasks connect
+through a dedicated pool of one connection per worker, so they never wait
+for, nor starve, the connections serving the other requests
+"""
+
+from backend.app import logger
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from collections import OrderedDict
+from sqlalchemy import create_engine, exc, text
+import re
+import time
+
+SNAPSHOT_ID = re.compile(r"^[0-9A-Fa-f-]+$")
+
+
+class StatsExecutor(object):
+    """
+    Bounded thread pool for statistics sections
+    """
+
+    def __init__(self, url, max_workers=3, timeout=30):
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.engine = create_engine(url, pool_size=max_workers, max_overflow=0)
+
+    def run(self, engine, tasks):
+        """
+        Run {name: task(connection)}, return (results, errors) by name
+        The snapshot is exported on a connection of engine, the timeout
+        counts from submission and includes the wait for a worker
+        """
+
+        results = OrderedDict()
+        errors = OrderedDict()
+
+        with engine.connect() as leader:
+            leader = leader.execution_options(
+                isolation_level="REPEATABLE READ"
+            )
+            transaction = leader.begin()
+
+            try:
+                # Keep the exporting transaction open until every task
+                # finished, importers need it alive
+                snapshot = leader.execute(
+                    text("SELECT pg_export_snapshot()")
+                ).scalar()
+
+                deadline = time.monotonic() + self.timeout
+                futures = OrderedDict(
+                    (
+                        name,
+                        self.pool.submit(
+                            self.run_task, snapshot, deadline, name, task
+                        ),
+                    )
+                    for name, task in tasks.items()
+                )
+
+                for name, future in futures.items():
+                    try:
+                        results[name] = future.result(
+                            timeout=max(0, deadline - time.monotonic())
+                        )
+
+                    except TimeoutError:
+                        logger.error(
+                            "Statistics section {} timed out.".format(name)
+                        )
+                        future.cancel()
+                        errors[name] = "Timed out"
+
+                    except Exception as e:
+                        logger.error(
+                            "Statistics section {} failed.".format(name)
+                        )
+                        logger.error(e)
+                        errors[name] = "Unable to compute statistics"
+
+            finally:
+                transaction.rollback()
+
+        return results, errors
+
+    def run_task(self, snapshot, deadline, name, task):
+        """
+        Run a task in a read-only transaction on the shared snapshot,
+        its statements are cancelled at the deadline
+        """
+
+        if not SNAPSHOT_ID.match(snapshot):
+            raise exc.ArgumentError("Invalid snapshot {}".format(snapshot))
+
+        started = time.monotonic()
+
+        if started >= deadline:
+            raise TimeoutError()
+
+        with self.engine.connect() as connection:
+            connection = connection.execution_options(
+                isolation_level="REPEATABLE READ"
+            )
+            transaction = connection.begin()
+
+            try:
+                connection.execute(
+                    "SET TRANSACTION SNAPSHOT '{}'".format(snapshot)
+                )
+                connection.execute("SET TRANSACTION READ ONLY")
+                connection.execute(
+                    "SET LOCAL statement_timeout = {:d}".format(
+                        max(1, int((deadline - time.monotonic()) * 1000))
+                    )
+                )
+
+                return task(connection)
+
+            finally:
+                transaction.rollback()
+                logger.debug(
+                    "Statistics section {} took {:.3f} s.".format(
+                        name, time.monotonic() - started
+                    )
+                )
@@ -0,0 +1,233 @@
+"""
+Streaming Visit Statistics
+Visits are read in chunks through a server-side cursor and folded into
+running counters, memory depends on the chunk size and number of patients
+rather than on the visit history
+"""
+
+from backend.app import logger
+from backend.common.stats_engine import (
+    StatsEngine,
+    SECTIONS,
+    VISIT_LIST_COUNTS,
+    MISSING,
+    count_frame,
+    element_frame,
+)
+from backend.common.stats_counters import json_list
+from collections import Counter
+from sqlalchemy import text
+import pandas as pd
+
+
+def counter_frame(counter, column):
+    """
+    Pre-aggregated frame of a counter, same shape as the SQL counts
+    """
+
+    return pd.DataFrame(
+        {column: list(counter.keys()), "count": list(counter.values())},
+        columns=[column, "count"],
+    )
+
+
+def most_common(counter):
+    """
+    Counter items ordered by count, then by element
+    """
+
+    return sorted(counter.items(), key=lambda item: (-item[1], item[0]))
+
+
+class StreamingStatsEngine(StatsEngine):
+    """
+    Compute visit statistics from chunks of visit rows
+    """
+
+    def __init__(self, bind, chunksize=5000, **filters):
+        StatsEngine.__init__(self, bind, **filters)
+        self.chunksize = chunksize
+
+    def read_chunks(self, sql, source="stats", **params):
+        """
+        Yield frames of at most chunksize rows from a server-side cursor
+        """
+
+        rows = 0
+
+        for chunk in pd.read_sql(
+            text(sql),
+            self.bind.execution_options(stream_results=True),
+            params=dict(self.params, **params),
+            chunksize=self.chunksize,
+        ):
+            rows += len(chunk)
+            yield chunk
+
+        logger.debug(
+            "Statistics {}: streamed {} rows in chunks of {}.".format(
+                source, rows, self.chunksize
+            )
+        )
+
+    def visit_stats(self, statistics=None):
+        """
+        Visit statistics, each patient keeps only its latest visit
+        """
+
+        statistics = statistics or SECTIONS["visit"]
+        list_counts = [
+            (key, spec)
+            for key, spec in VISIT_LIST_COUNTS.items()
+            if key in statistics
+        ]
+
+        visit_columns = [
+            column
+            for _, (column, _, last_visit) in list_counts
+            if not last_visit
+        ]
+        last_visit_columns = [
+            column for _, (column, _, last_visit) in list_counts if last_visit
+        ]
+
+        if "count_monthly_visit" in statistics:
+            visit_columns.append("imp")
+
+        if "count_why_switched_arv" in statistics:
+            visit_columns.append("why_switched_arv")
+
+        if "count_arv_regimen" in statistics:
+            last_visit_columns.append("arv")
+
+        visit_columns = sorted(set(visit_columns))
+        last_visit_columns = sorted(set(last_visit_columns))
+
+        # Running aggregates
+        monthly = Counter()
+        why_switched = Counter()
+        elements = {key: Counter() for key, _ in list_counts}
+        latest = {}
+        has_visit = False
+
+        for chunk in self.read_chunks(
+            """
+            SELECT id, paitent_id, date,
+                date_trunc(:granularity, date::timestamp) AS bucket
+                {columns}
+            FROM visit
+            {where}
+            """.format(
+                columns="".join(
+                    ", " + c
+                    for c in sorted(set(visit_columns + last_visit_columns))
+                ),
+                where=self.where("date"),
+            ),
+            source="visit",
+        ):
+            has_visit = has_visit or not chunk.empty
+
+            if "count_monthly_visit" in statistics:
+                with_imp = chunk["imp"].notna() & (chunk["imp"] != "null")
+
+                for bucket, count in (
+                    with_imp.groupby(chunk["bucket"]).sum().items()
+                ):
+                    monthly[bucket] += int(count)
+
+            if "count_why_switched_arv" in statistics:
+                why_switched.update(chunk["why_switched_arv"].dropna().values)
+
+            for key, (column, _, last_visit) in list_counts:
+                if not last_visit:
+                    for value in chunk[column].values:
+                        elements[key].update(map(str, json_list(value)))
+
+            if last_visit_columns:
+                # Only the latest visit of each patient in the chunk can
+                # replace the one already kept
+                candidates = chunk.sort_values(
+                    ["paitent_id", "date", "id"]
+                ).drop_duplicates(subset=["paitent_id"], keep="last")
+
+                for row in candidates[
+                    ["paitent_id", "date", "id"] + last_visit_columns
+                ].itertuples(index=False):
+                    patient = None if pd.isnull(row[0]) else int(row[0])
+                    kept = latest.get(patient)
+
+                    if kept is None or (row[1], row[2]) > kept[:2]:
+                        latest[patient] = tuple(row[1:])
+
+        if not has_visit:
+            return {}
+
+        results = {}
+
+        # Monthly Stats
+        if "count_monthly_visit" in statistics:
+            labels_df = self.read_sql(
+                """
+                SELECT bucket, to_char(bucket, :label_format) AS label
+                FROM generate_series(
+                    CAST(:first AS timestamp),
+                    CAST(:last AS timestamp),
+                    CAST(:step AS interval)
+                ) AS bucket
+                """,
+                source="visit",
+                first=min(monthly).to_pydatetime(),
+                last=max(monthly).to_pydatetime(),
+            )
+            results["count_monthly_visit"] = pd.DataFrame(
+                {
+                    "Month/Year": labels_df["label"].values,
+                    "Number of Visit": [
+                        monthly.get(bucket, 0)
+                        for bucket in labels_df["bucket"]
+                    ],
+                },
+                columns=["Month/Year", "Number of Visit"],
+            )
+
+        # Latest visit of each patient
+        last_visits = [
+            dict(zip(last_visit_columns, values[2:]))
+            for values in latest.values()
+        ]
+
+        # Overall Stats
+        # Current ARV Regimens
+        if "count_arv_regimen" in statistics:
+            regimens = Counter(
+                ", ".join(map(str, json_list(visit["arv"])))
+                for visit in last_visits
+            )
+            regimens.pop("", None)
+            results["count_arv_regimen"] = count_frame(
+                counter_frame(regimens, "regimen"), "regimen", "ARV Regimens"
+            )
+
+        # Switching ARV?
+        if "count_why_switched_arv" in statistics:
+            results["count_why_switched_arv"] = count_frame(
+                counter_frame(why_switched, "why_switched_arv"),
+                "why_switched_arv",
+                "Why Change ARV Regimens",
+            ).fillna(MISSING)
+
+        # OI, Anti TB, ARV Breakdown, Vaccination and Impressions
+        for key, (column, output_column_name, last_visit) in list_counts:
+            if last_visit:
+                for visit in last_visits:
+                    elements[key].update(map(str, json_list(visit[column])))
+
+            counts = most_common(elements[key])
+            results[key] = element_frame(
+                [element for element, _ in counts],
+                [count for _, count in counts],
+                output_column_name,
+            )
+
+        return results
@@ -0,0 +1,163 @@
+"""
+Suggestion Dictionary
+Usage counts of the free-text field values are adjusted in the same
+transaction as the patient and child writes, autocomplete only reads them
+"""
+
+from backend.app import db, logger
+from backend.models import Patient, FieldSuggestion
+from backend.common.field_search import FREE_TEXT_FIELDS
+from backend.common.stats_counters import current_values, committed_values
+from sqlalchemy import event, func, text
+from sqlalchemy.dialects.postgresql import insert
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+PENDING_KEY = "field_suggestion_pending"
+
+# Model -> field names stored in the dictionary
+SUGGESTION_FIELDS = OrderedDict()
+
+for field_name, column in FREE_TEXT_FIELDS.items():
+    SUGGESTION_FIELDS.setdefault(column.class_, []).append(field_name)
+
+
+def suggestion_values(values):
+    """
+    (field name, value) pairs of a row, blank answers are skipped
+    """
+
+    for field_name, value in values.items():
+        if value is not None and value.strip():
+            yield (field_name, value)
+
+
+@event.listens_for(db.session, "before_flush")
+def collect_suggestion_changes(session, flush_context, instances):
+    """
+    Compute usage deltas of the rows about to be written
+    """
+
+    deltas = Counter()
+
+    def count(obj, values, delta):
+        columns = SUGGESTION_FIELDS[type(obj)]
+
+        for suggestion in suggestion_values(values(obj, columns)):
+            deltas[suggestion] += delta
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if type(obj) in SUGGESTION_FIELDS:
+                count(obj, current_values, 1)
+
+        for obj in session.dirty:
+            if type(obj) in SUGGESTION_FIELDS and session.is_modified(obj):
+                count(obj, committed_values, -1)
+                count(obj, current_values, 1)
+
+        for obj in session.deleted:
+            if type(obj) in SUGGESTION_FIELDS:
+                count(obj, committed_values, -1)
+
+            if isinstance(obj, Patient):
+                # Children are removed by the delete cascade
+                for child_type in ["visits", "imaging", "appointments"]:
+                    for child in getattr(obj, child_type):
+                        if child not in session.deleted:
+                            count(child, committed_values, -1)
+
+    session.info[PENDING_KEY] = deltas
+
+
+@event.listens_for(db.session, "after_flush")
+def apply_suggestion_changes(session, flush_context):
+    """
+    Write usage deltas in the flush transaction
+    """
+
+    write_suggestion_deltas(session, session.info.pop(PENDING_KEY, Counter()))
+
+
+def write_suggestion_deltas(session, deltas):
+    """
+    Add usage deltas to the dictionary, values are created as needed
+    """
+
+    now = datetime.utcnow()
+
+    # Same lock order in every transaction, concurrent upserts can't deadlock
+    rows = [
+        {
+            "field_name": field_name,
+            "value": value,
+            "usage_count": delta,
+            "last_used": now if delta > 0 else None,
+        }
+        for (field_name, value), delta in sorted(deltas.items())
+        if delta
+    ]
+
+    if not rows:
+        return
+
+    logger.debug("Updating {} field suggestions.".format(len(rows)))
+
+    table = FieldSuggestion.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.field_name, func.md5(table.c.value)],
+        set_={
+            "usage_count": table.c.usage_count + stmt.excluded.usage_count,
+            "last_used": func.coalesce(
+                stmt.excluded.last_used, table.c.last_used
+            ),
+        },
+    )
+    session.execute(stmt, rows)
+
+
+def rebuild_statements():
+    """
+    Set-based SQL recomputing the dictionary from the base tables
+    """
+
+    selects = []
+
+    for field_name, column in FREE_TEXT_FIELDS.items():
+        selects.append(
+            """
+            SELECT '{field_name}', {column}, count(*), max(modify_timestamp)
+            FROM {table}
+            WHERE {column} IS NOT NULL AND btrim({column}) <> ''
+            GROUP BY {column}
+            """.format(
+                field_name=field_name,
+                column=column.key,
+                table=column.class_.__tablename__,
+            )
+        )
+
+    return [
+        "DELETE FROM field_suggestion",
+        """
+        INSERT INTO field_suggestion (field_name, value, usage_count,
+            last_used)
+        {}
+        """.format(
+            " UNION ALL ".join(selects)
+        ),
+    ]
+
+
+def rebuild_suggestions(session):
+    """
+    Recompute the suggestion dictionary, backfills existing data
+    """
+
+    session.execute(text("LOCK TABLE field_suggestion IN EXCLUSIVE MODE"))
+
+    for statement in rebuild_statements():
+        session.execute(text(statement))
+
+    return session.query(FieldSuggestion).count()
@@ -29,3 +29,41 @@ class Config(object):
     # Data Pagination
     MAX_PAGINATION = int(os.environ.get("MAX_PAGINATION"))
     MAX_SEARCH_RESULT = int(os.environ.get("MAX_SEARCH_RESULT"))
+
+    # Cached autocomplete results per worker, entries and seconds
+    # The TTL bounds how long a write of another worker goes unseen
+    SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1024))
+    SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 60))
+
+    # ICD10-CM code set, its index snapshot is memory-mapped by every worker
+    ICD10_FILE = os.environ.get(
+        "ICD10_FILE", "./backend/icd10cm_codes_2019.txt"
+    )
+    ICD10_SNAPSHOT = os.environ.get(
+        "ICD10_SNAPSHOT", "./backend/icd10cm_codes_2019.idx"
+    )
+
+    # Load the ICD10 codes into the DB on the first request, otherwise
+    # run `flask icd10 load`
+    ICD10_LOAD_ON_STARTUP = (
+        os.environ.get("ICD10_LOAD_ON_STARTUP", "true") == "true"
+    )
+
+    # Statistics
+    # Serve /api/stats from the counters maintained on every write
+    STATS_COUNTERS = os.environ.get("STATS_COUNTERS", "true") == "true"
+
+    # Cached /api/stats responses, seconds and bytes per worker
+    STATS_CACHE_TTL = int(os.environ.get("STATS_CACHE_TTL", 300))
+    STATS_CACHE_MAX_BYTES = int(
+        os.environ.get("STATS_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+    )
+
+    # Concurrent statistics sections, worker threads (each with its own DB
+    # connection) and seconds per request
+    STATS_WORKERS = int(os.environ.get("STATS_WORKERS", 3))
+    STATS_SECTION_TIMEOUT = int(os.environ.get("STATS_SECTION_TIMEOUT", 30))
+
+    # Stream visits in chunks of this many rows when counters are not
+    # used, 0 aggregates them in SQL
+    STATS_STREAM_CHUNKSIZE = int(os.environ.get("STATS_STREAM_CHUNKSIZE", 0))
@@ -0,0 +1,40 @@
+"""data version sequence
+
+Revision ID: 1c7d3e9a5b84
+Revises: 4e8a2c6f1b37
+Create Date: 2026-10-17 22:41:06.527193
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "1c7d3e9a5b84"
+down_revision = "4e8a2c6f1b37"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Versions cached statistics, replaces the data.version counter row
+    # Starts above it, ETags of the old versions never match a new one
+    op.execute("CREATE SEQUENCE data_version_seq")
+    op.execute(
+        """
+        SELECT setval('data_version_seq', COALESCE(max(count), 0) + 1, true)
+        FROM stats_counter
+        WHERE statistic = 'data.version' AND period = '' AND key = ''
+        """
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+        INSERT INTO stats_counter (statistic, period, key, count)
+        SELECT 'data.version', '', '', last_value + 1 FROM data_version_seq
+        ON CONFLICT (statistic, period, key)
+        DO UPDATE SET count = excluded.count
+        """
+    )
+    op.execute("DROP SEQUENCE data_version_seq")
@@ -0,0 +1,37 @@
+"""code set versions
+
+Revision ID: 2d6f8a1c4b95
+Revises: 9e4a1b6c2f73
+Create Date: 2026-10-17 17:05:41.328710
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "2d6f8a1c4b95"
+down_revision = "9e4a1b6c2f73"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # code_set table
+    # Record the ICD10 codes with `flask icd10 load` after upgrading
+    op.create_table(
+        "code_set",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("name", sa.Unicode(), nullable=False),
+        sa.Column("version", sa.Unicode(), nullable=False),
+        sa.Column("checksum", sa.Unicode(), nullable=False),
+        sa.Column("rows", sa.Integer(), nullable=False),
+        sa.Column("loaded_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("id"),
+        sa.UniqueConstraint("name"),
+    )
+
+
+def downgrade():
+    op.drop_table("code_set")
@@ -0,0 +1,157 @@
+"""statistics counters
+
+Revision ID: 3f1c9e7b52d4
+Revises: a82dee92edf3
+Create Date: 2026-10-17 09:12:31.418205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3f1c9e7b52d4"
+down_revision = "a82dee92edf3"
+branch_labels = None
+depends_on = None
+
+MISSING = "Missing/None"
+
+# Counted patient columns, by first encounter month
+COUNTER_DIMENSIONS = [
+    "education",
+    "nationality",
+    "sex",
+    "gender",
+    "marital",
+    "is_refer",
+    "refer_from",
+    "bill_payer",
+]
+
+# Visit columns counted on every visit and on the latest visit only
+VISIT_ELEMENTS = ["vaccination", "imp"]
+LAST_VISIT_ELEMENTS = ["arv", "oi_prophylaxis", "anti_tb"]
+
+
+def json_elements(column):
+    return (
+        "json_array_elements_text(CASE WHEN json_typeof({0}::json) = 'array'"
+        " THEN {0}::json ELSE '[]'::json END)"
+    ).format(column)
+
+
+def coalesce(column):
+    return "COALESCE({}, '{}')".format(column, MISSING)
+
+
+def populate_counters():
+    """
+    Count the existing data as `flask stats rebuild` does, the counters
+    are read as soon as the migration is applied
+    """
+
+    selects = [
+        """
+        SELECT 'patient.{0}', {1}, {2}, count(*)
+        FROM patient GROUP BY 2, 3
+        """.format(
+            dimension,
+            coalesce("to_char(first_encounter, 'YYYY-MM')"),
+            coalesce(dimension),
+        )
+        for dimension in COUNTER_DIMENSIONS
+    ]
+    selects.append(
+        """
+        SELECT 'patient.dob', '', to_char(dob, 'YYYY-MM'), count(*)
+        FROM patient WHERE dob IS NOT NULL GROUP BY 3
+        """
+    )
+    selects.append(
+        """
+        SELECT 'visit.monthly', to_char(date, 'YYYY-MM'), '', count(*)
+        FROM visit WHERE imp IS NOT NULL AND imp <> 'null' GROUP BY 2
+        """
+    )
+    selects.append(
+        """
+        SELECT 'visit.why_switched_arv', '', why_switched_arv, count(*)
+        FROM visit WHERE why_switched_arv IS NOT NULL GROUP BY 3
+        """
+    )
+    selects.extend(
+        """
+        SELECT 'visit.{0}', '', element, count(*)
+        FROM visit, {1} AS element GROUP BY 3
+        """.format(
+            column, json_elements(column)
+        )
+        for column in VISIT_ELEMENTS
+    )
+    selects.append(
+        """
+        SELECT 'last_visit.arv_regimen', '', regimen, count(*)
+        FROM (
+            SELECT NULLIF(array_to_string(ARRAY(SELECT {}), ', '), '')
+                AS regimen
+            FROM last_visit
+        ) AS regimens
+        WHERE regimen IS NOT NULL GROUP BY 3
+        """.format(
+            json_elements("arv")
+        )
+    )
+    selects.extend(
+        """
+        SELECT 'last_visit.{0}', '', element, count(*)
+        FROM last_visit, {1} AS element GROUP BY 3
+        """.format(
+            column, json_elements(column)
+        )
+        for column in LAST_VISIT_ELEMENTS
+    )
+
+    op.execute(
+        """
+        INSERT INTO stats_counter (statistic, period, key, count)
+        WITH last_visit AS (
+            SELECT DISTINCT ON (paitent_id) {columns}
+            FROM visit
+            ORDER BY paitent_id, date DESC, id DESC
+        )
+        {selects}
+        """.format(
+            columns=", ".join(LAST_VISIT_ELEMENTS),
+            selects=" UNION ALL ".join(selects),
+        )
+    )
+
+
+def upgrade():
+    # stats_counter table
+    op.create_table(
+        "stats_counter",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("statistic", sa.Unicode(), nullable=False),
+        sa.Column("period", sa.Unicode(), nullable=False),
+        sa.Column("key", sa.Unicode(), nullable=False),
+        sa.Column("count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("id"),
+        sa.UniqueConstraint("statistic", "period", "key"),
+    )
+    op.create_index(
+        op.f("ix_stats_counter_statistic"),
+        "stats_counter",
+        ["statistic"],
+        unique=False,
+    )
+    populate_counters()
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_stats_counter_statistic"), table_name="stats_counter"
+    )
+    op.drop_table("stats_counter")
@@ -0,0 +1,33 @@
+"""patient history indexes
+
+Revision ID: 4e8a2c6f1b37
+Revises: 7b1e5c3a9d42
+Create Date: 2026-10-17 21:03:27.184529
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "4e8a2c6f1b37"
+down_revision = "7b1e5c3a9d42"
+branch_labels = None
+depends_on = None
+
+# Child tables read latest first by /api/patient/<hn>/overview
+HISTORY_TABLES = ["visit", "lab", "imaging", "appointment"]
+
+
+def upgrade():
+    for table in HISTORY_TABLES:
+        op.create_index(
+            "ix_{}_paitent_id_date".format(table),
+            table,
+            ["paitent_id", "date"],
+            unique=False,
+        )
+
+
+def downgrade():
+    for table in reversed(HISTORY_TABLES):
+        op.drop_index("ix_{}_paitent_id_date".format(table), table_name=table)
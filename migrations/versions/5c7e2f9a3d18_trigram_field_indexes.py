@@ -0,0 +1,26 @@
+"""trigram matching for free-text autocomplete
+
+Revision ID: 5c7e2f9a3d18
+Revises: 8b2d4a6c1e90
+Create Date: 2026-10-17 14:26:09.513842
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5c7e2f9a3d18"
+down_revision = "8b2d4a6c1e90"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Free-text autocomplete reads the field_suggestion dictionary of
+    # 9e4a1b6c2f73, only its value column is trigram indexed
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+
+def downgrade():
+    # pg_trgm is left installed, other database objects may use it
+    pass
@@ -0,0 +1,38 @@
+"""icd10 code set versions
+
+Revision ID: 6a3c9d0e7f21
+Revises: 2d6f8a1c4b95
+Create Date: 2026-10-17 18:37:15.904126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "6a3c9d0e7f21"
+down_revision = "2d6f8a1c4b95"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("icd10", sa.Column("version", sa.Unicode(), nullable=True))
+    op.add_column(
+        "icd10", sa.Column("retired_version", sa.Unicode(), nullable=True)
+    )
+
+    # Racing loaders could insert a code twice, keep the first row
+    op.execute(
+        """
+        DELETE FROM icd10 AS a USING icd10 AS b
+        WHERE a.icd10 = b.icd10 AND a.id > b.id
+        """
+    )
+    op.create_index(op.f("ix_icd10_icd10"), "icd10", ["icd10"], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_icd10_icd10"), table_name="icd10")
+    op.drop_column("icd10", "retired_version")
+    op.drop_column("icd10", "version")
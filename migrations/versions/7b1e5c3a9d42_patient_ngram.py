@@ -0,0 +1,101 @@
+"""patient n-gram index
+
+Revision ID: 7b1e5c3a9d42
+Revises: 6a3c9d0e7f21
+Create Date: 2026-10-17 20:14:52.671093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import unicodedata
+
+
+# revision identifiers, used by Alembic.
+revision = "7b1e5c3a9d42"
+down_revision = "6a3c9d0e7f21"
+branch_labels = None
+depends_on = None
+
+# Searchable patient columns
+NGRAM_COLUMNS = ["name", "hn", "gov_id", "nap", "refer_from"]
+NGRAM_SIZES = (2, 3)
+
+# Rows inserted per statement
+BATCH_SIZE = 5000
+
+
+def patient_grams(values):
+    """
+    Grams of a patient as the application computes them
+    """
+
+    grams = set()
+
+    for value in values:
+        if value:
+            value = " ".join(
+                unicodedata.normalize("NFC", value).lower().split()
+            )
+
+            for n in NGRAM_SIZES:
+                grams.update(
+                    value[i : i + n] for i in range(len(value) - n + 1)
+                )
+
+    return grams
+
+
+def populate_ngrams():
+    """
+    Index the existing patients as `flask patients reindex` does, search
+    skips the full text fallback as soon as any patient has grams
+    """
+
+    connection = op.get_bind()
+    ngram = sa.table(
+        "patient_ngram", sa.column("gram"), sa.column("patient_id")
+    )
+    patients = connection.execution_options(stream_results=True).execute(
+        sa.text("SELECT id, {} FROM patient".format(", ".join(NGRAM_COLUMNS)))
+    )
+    rows = []
+
+    for patient in patients:
+        rows.extend(
+            {"gram": gram, "patient_id": patient[0]}
+            for gram in patient_grams(patient[1:])
+        )
+
+        if len(rows) >= BATCH_SIZE:
+            connection.execute(ngram.insert(), rows)
+            rows = []
+
+    if rows:
+        connection.execute(ngram.insert(), rows)
+
+
+def upgrade():
+    # patient_ngram table
+    op.create_table(
+        "patient_ngram",
+        sa.Column("gram", sa.Unicode(), nullable=False),
+        sa.Column("patient_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["patient_id"], ["patient.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("gram", "patient_id"),
+    )
+    op.create_index(
+        op.f("ix_patient_ngram_patient_id"),
+        "patient_ngram",
+        ["patient_id"],
+        unique=False,
+    )
+    populate_ngrams()
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_patient_ngram_patient_id"), table_name="patient_ngram"
+    )
+    op.drop_table("patient_ngram")
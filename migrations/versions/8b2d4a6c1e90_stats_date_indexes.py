@@ -0,0 +1,33 @@
+"""statistics date indexes
+
+Revision ID: 8b2d4a6c1e90
+Revises: 3f1c9e7b52d4
+Create Date: 2026-10-17 11:02:47.902311
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "8b2d4a6c1e90"
+down_revision = "3f1c9e7b52d4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Date range filters of /api/stats
+    op.create_index(op.f("ix_visit_date"), "visit", ["date"], unique=False)
+    op.create_index(op.f("ix_lab_date"), "lab", ["date"], unique=False)
+    op.create_index(
+        op.f("ix_patient_first_encounter"),
+        "patient",
+        ["first_encounter"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_patient_first_encounter"), table_name="patient")
+    op.drop_index(op.f("ix_lab_date"), table_name="lab")
+    op.drop_index(op.f("ix_visit_date"), table_name="visit")
@@ -0,0 +1,94 @@
+"""field suggestion dictionary
+
+Revision ID: 9e4a1b6c2f73
+Revises: 5c7e2f9a3d18
+Create Date: 2026-10-17 15:48:22.160457
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9e4a1b6c2f73"
+down_revision = "5c7e2f9a3d18"
+branch_labels = None
+depends_on = None
+
+# Free-text columns of /api/search/field_entries
+FREE_TEXT_COLUMNS = [
+    ("patient", "refer_from"),
+    ("visit", "art_adherence_problem"),
+    ("visit", "why_switched_arv"),
+    ("imaging", "film_type"),
+    ("imaging", "result"),
+    ("appointment", "appointment_for"),
+]
+
+
+def populate_suggestions():
+    """
+    Count the used values as `flask suggestions rebuild` does, free-text
+    autocomplete only reads the dictionary
+    """
+
+    op.execute(
+        """
+        INSERT INTO field_suggestion (field_name, value, usage_count,
+            last_used)
+        {}
+        """.format(
+            " UNION ALL ".join(
+                """
+                SELECT '{column}', {column}, count(*), max(modify_timestamp)
+                FROM {table}
+                WHERE {column} IS NOT NULL AND btrim({column}) <> ''
+                GROUP BY {column}
+                """.format(
+                    table=table, column=column
+                )
+                for table, column in FREE_TEXT_COLUMNS
+            )
+        )
+    )
+
+
+def upgrade():
+    # field_suggestion table
+    op.create_table(
+        "field_suggestion",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("field_name", sa.Unicode(), nullable=False),
+        sa.Column("value", sa.Unicode(), nullable=False),
+        sa.Column("usage_count", sa.Integer(), nullable=False),
+        sa.Column("last_used", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("id"),
+    )
+    # Hash of the value, long free text exceeds the btree row size
+    op.create_index(
+        "ix_field_suggestion_field_name_value_md5",
+        "field_suggestion",
+        [sa.text("field_name"), sa.text("md5(value)")],
+        unique=True,
+    )
+    op.create_index(
+        "ix_field_suggestion_value_trgm",
+        "field_suggestion",
+        ["value"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"value": "gin_trgm_ops"},
+    )
+    populate_suggestions()
+
+
+def downgrade():
+    op.drop_index(
+        "ix_field_suggestion_value_trgm", table_name="field_suggestion"
+    )
+    op.drop_index(
+        "ix_field_suggestion_field_name_value_md5",
+        table_name="field_suggestion",
+    )
+    op.drop_table("field_suggestion")
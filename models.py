@@ -4,7 +4,8 @@ Database model, using Flask-SQLAlchemy
 
 from backend.app import db, logger
 from datetime import datetime
-from sqlalchemy import exists
+from sqlalchemy import exists, or_
+
 # from sqlalchemy import DateTime as SdateTime
 # from sqlalchemy.types import TypeDecorator
 from sqlalchemy.inspection import inspect
@@ -50,6 +51,29 @@ class SearchableMixin(BaseQuery, SearchQueryMixin):
     pass
 
 
+def trigram_index(table, column):
+    """
+    GIN trigram index, substring search on a free-text column
+    """
+
+    return db.Index(
+        "ix_{}_{}_trgm".format(table, column),
+        column,
+        postgresql_using="gin",
+        postgresql_ops={column: "gin_trgm_ops"},
+    )
+
+
+def history_index(table):
+    """
+    Records of a patient ordered by date, latest first reads
+    """
+
+    return db.Index(
+        "ix_{}_paitent_id_date".format(table), "paitent_id", "date"
+    )
+
+
 class BaseModel(db.Model, Serializer):
     """
     Base model for all tables
@@ -70,22 +94,40 @@ class BaseModel(db.Model, Serializer):
     def update(self, **kwargs):
         """
         Update column using the provided dictionary
+        Columns missing from the dictionary are cleared
+        """
+
+        return self.patch(
+            **{key: kwargs.get(key) for key in self.__mapper__.columns.keys()}
+        )
+
+    def patch(self, **kwargs):
+        """
+        Partial update, JSON Merge Patch semantics: only the provided
+        columns are set and None clears a column. Columns keeping their
+        value are not written, so an unchanged record is not updated.
+        Returns the names of the changed columns
         """
 
-        all_keys = list(vars(self).keys())
-        updated_keys = list(kwargs.keys())
+        columns = self.__mapper__.columns.keys()
+        changed = set()
 
-        for key in all_keys:
-            if key in self.__skip__:
+        for key, value in kwargs.items():
+            if (
+                key in self.__skip__
+                or key in self.__protected__
+                or key not in columns
+            ):
                 continue
 
-            elif (key in updated_keys) and (key not in self.__protected__):
-                setattr(self, key, kwargs[key])
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+                changed.add(key)
 
-            elif key not in self.__protected__:
-                setattr(self, key, None)
+        if changed:
+            self.modify_timestamp = datetime.utcnow()
 
-        self.modify_timestamp = datetime.utcnow()
+        return changed
 
     @classmethod
     def is_exists(self, col, str_filter):
@@ -103,6 +145,58 @@ class BaseModel(db.Model, Serializer):
 
         return is_exists
 
+    @classmethod
+    def existing_values(self, values, exclude_id=None):
+        """
+        Names of the columns whose value is already stored, every column
+        is checked with a single query
+        """
+
+        values = {col: value for col, value in values.items() if value}
+
+        if not values:
+            return set()
+
+        columns = [getattr(self, col) for col in values]
+        query = db.session.query(*columns).filter(
+            or_(*[column == values[column.key] for column in columns])
+        )
+
+        if exclude_id is not None:
+            query = query.filter(self.id != exclude_id)
+
+        return {
+            col
+            for row in query
+            for col, value in zip(values, row)
+            if value == values[col]
+        }
+
+    @classmethod
+    def taken_values(self, values):
+        """
+        Already stored values of many candidates, column name -> set
+        every column is checked with a single query
+        """
+
+        values = {col: set(v) for col, v in values.items() if v}
+        taken = {col: set() for col in values}
+
+        if not values:
+            return taken
+
+        columns = [getattr(self, col) for col in values]
+        query = db.session.query(*columns).filter(
+            or_(*[column.in_(values[column.key]) for column in columns])
+        )
+
+        for row in query:
+            for col, value in zip(values, row):
+                if value in values[col]:
+                    taken[col].add(value)
+
+        return taken
+
     def serialize(self):
         """
         Serialize Model object
@@ -146,6 +240,10 @@ class BaseModel(db.Model, Serializer):
         try:
             for key in self.__json__:
                 try:
+                    # Keep null, a merge patch clears the column
+                    if data[key] is None:
+                        continue
+
                     if isinstance(data[key], (list, tuple)):
                         data[key].sort()
 
@@ -181,7 +279,7 @@ class Patient(BaseModel):
     gov_id = db.Column(db.Unicode(), unique=True)
     name = db.Column(db.Unicode())
     dob = db.Column(db.Date)
-    first_encounter = db.Column(db.Date)
+    first_encounter = db.Column(db.Date, index=True)
     sex = db.Column(db.Unicode())
     gender = db.Column(db.Unicode())
     marital = db.Column(db.Unicode())
@@ -246,7 +344,13 @@ class Visit(BaseModel):
     """
 
     __tablename__ = "visit"
-    __protected__ = ["id", "patient_id", "timestamp", "modify_timestamp"]
+    __protected__ = [
+        "id",
+        "patient_id",
+        "paitent_id",
+        "timestamp",
+        "modify_timestamp",
+    ]
     __json__ = [
         "abn_pe",
         "imp",
@@ -255,8 +359,9 @@ class Visit(BaseModel):
         "anti_tb",
         "vaccination",
     ]
+    __table_args__ = (history_index("visit"),)
 
-    date = db.Column(db.Date, nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     is_art_adherence = db.Column(db.Unicode())
     art_adherence_scale = db.Column(db.Float)
     art_delay = db.Column(db.Float)
@@ -280,9 +385,16 @@ class Lab(BaseModel):
     """
 
     __tablename__ = "lab"
-    __protected__ = ["id", "patient_id", "timestamp", "modify_timestamp"]
+    __protected__ = [
+        "id",
+        "patient_id",
+        "paitent_id",
+        "timestamp",
+        "modify_timestamp",
+    ]
+    __table_args__ = (history_index("lab"),)
 
-    date = db.Column(db.Date, nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     anti_hiv = db.Column(db.Unicode(3))
     cd4 = db.Column(db.Integer)
     p_cd4 = db.Column(db.Float)
@@ -309,7 +421,14 @@ class Imaging(BaseModel):
     """
 
     __tablename__ = "imaging"
-    __protected__ = ["id", "patient_id", "timestamp", "modify_timestamp"]
+    __protected__ = [
+        "id",
+        "patient_id",
+        "paitent_id",
+        "timestamp",
+        "modify_timestamp",
+    ]
+    __table_args__ = (history_index("imaging"),)
 
     date = db.Column(db.Date, nullable=False)
     film_type = db.Column(db.Unicode())
@@ -324,7 +443,14 @@ class Appointment(BaseModel):
     """
 
     __tablename__ = "appointment"
-    __protected__ = ["id", "patient_id", "timestamp", "modify_timestamp"]
+    __protected__ = [
+        "id",
+        "patient_id",
+        "paitent_id",
+        "timestamp",
+        "modify_timestamp",
+    ]
+    __table_args__ = (history_index("appointment"),)
 
     date = db.Column(db.Date, nullable=False)
     appointment_for = db.Column(db.Unicode(), nullable=False)
@@ -340,15 +466,36 @@ class ICD10(BaseModel):
     __tablename__ = "icd10"
     __protected__ = ["id"]
 
-    icd10 = db.Column(db.Unicode(), nullable=False)
+    icd10 = db.Column(db.Unicode(), nullable=False, unique=True, index=True)
     description = db.Column(db.Unicode(), nullable=False)
 
+    # Code set version of the description, and the version retiring the code
+    version = db.Column(db.Unicode())
+    retired_version = db.Column(db.Unicode())
+
     # Full text search support
     search_vector = db.Column(
         TSVectorType("icd10", "description", regconfig="pg_catalog.english")
     )
 
 
+class CodeSet(db.Model):
+    """
+    Store the version of the static code sets loaded in the DB
+    """
+
+    __tablename__ = "code_set"
+
+    id = db.Column(
+        db.Integer(), primary_key=True, unique=True, autoincrement=True
+    )
+    name = db.Column(db.Unicode(), nullable=False, unique=True)
+    version = db.Column(db.Unicode(), nullable=False)
+    checksum = db.Column(db.Unicode(), nullable=False)
+    rows = db.Column(db.Integer(), nullable=False, default=0)
+    loaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 class User(BaseModel):
     """
     Store website users
@@ -361,6 +508,66 @@ class User(BaseModel):
     password = db.Column(db.Unicode(), nullable=False)
 
 
+class PatientNgram(db.Model):
+    """
+    Character n-grams of the searchable patient columns
+    """
+
+    __tablename__ = "patient_ngram"
+
+    gram = db.Column(db.Unicode(), primary_key=True)
+    patient_id = db.Column(
+        db.Integer(),
+        db.ForeignKey("patient.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+
+
+class StatsCounter(db.Model):
+    """
+    Store pre-aggregated statistics, maintained on every write
+    """
+
+    __tablename__ = "stats_counter"
+    __table_args__ = (db.UniqueConstraint("statistic", "period", "key"),)
+
+    id = db.Column(
+        db.Integer(), primary_key=True, unique=True, autoincrement=True
+    )
+    statistic = db.Column(db.Unicode(), nullable=False, index=True)
+    period = db.Column(db.Unicode(), nullable=False, default="")
+    key = db.Column(db.Unicode(), nullable=False, default="")
+    count = db.Column(db.Integer(), nullable=False, default=0)
+
+
+class FieldSuggestion(db.Model):
+    """
+    Distinct values of the free-text fields, maintained on every write
+    """
+
+    __tablename__ = "field_suggestion"
+    __table_args__ = (trigram_index("field_suggestion", "value"),)
+
+    id = db.Column(
+        db.Integer(), primary_key=True, unique=True, autoincrement=True
+    )
+    field_name = db.Column(db.Unicode(), nullable=False)
+    value = db.Column(db.Unicode(), nullable=False)
+    usage_count = db.Column(db.Integer(), nullable=False, default=0)
+    last_used = db.Column(db.DateTime)
+
+
+# Values are unbounded free text (imaging results), a btree entry on the
+# value itself would exceed the index row size
+db.Index(
+    "ix_field_suggestion_field_name_value_md5",
+    FieldSuggestion.field_name,
+    db.func.md5(FieldSuggestion.value),
+    unique=True,
+)
+
+
 class RevokedToken(db.Model):
     __tablename__ = "revoked_token"
 
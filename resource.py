@@ -7,12 +7,19 @@ from backend.app import api
 # Resources
 from backend.resources.patient_resource import PatientResource
 from backend.resources.child_resource import ChildResource
+from backend.resources.patient_overview_resource import PatientOverviewResource
+from backend.resources.patient_import_resource import PatientImportResource
 from backend.resources.is_existed_resource import IsExistedResource
 from backend.resources.appointment_resource import AppointmentResource
 from backend.resources.stats_resource import StatsResource
 from backend.resources.login_resource import LoginResource
 from backend.resources.logout_resource import LogoutResource
-from backend.resources.ajax_form_search_resource import AjaxFormSearch
+from backend.resources.patient_search_resource import PatientSearchResource
+from backend.resources.batch_search_resource import BatchSearchResource
+from backend.resources.ajax_form_search_resource import (
+    AjaxFormSearch,
+    SearchCacheResource,
+)
 
 # REST reseources
 api.add_resource(PatientResource, "/api/patient", "/api/patient/<string:hn>")
@@ -21,9 +28,14 @@ api.add_resource(
     "/api/patient/<string:hn>/<string:child_type>",
     "/api/patient/<string:hn>/<string:child_type>/<string:record_id>",
 )
+api.add_resource(PatientOverviewResource, "/api/patient/<string:hn>/overview")
 api.add_resource(IsExistedResource, "/api/search/is_existed")
 api.add_resource(AjaxFormSearch, "/api/search/field_entries")
+api.add_resource(SearchCacheResource, "/api/search/cache")
+api.add_resource(BatchSearchResource, "/api/search/batch")
+api.add_resource(PatientSearchResource, "/api/search/patients")
+api.add_resource(PatientImportResource, "/api/import/patients")
 api.add_resource(AppointmentResource, "/api/appointment")
-api.add_resource(StatsResource, "/api/stats")
+api.add_resource(StatsResource, "/api/stats", "/api/stats/<string:section>")
 api.add_resource(LoginResource, "/api/login")
 api.add_resource(LogoutResource, "/api/logout")
@@ -0,0 +1,89 @@
+from flask_restful import Resource
+from backend.models import Patient
+from backend.common.field_search import SEARCH_FIELDS, search_field_entries
+from flask import jsonify, abort, request
+from backend.app import logger
+from webargs import fields
+from marshmallow import validate
+from webargs.flaskparser import parser
+from flask_jwt_extended import jwt_required
+
+# Items of each kind answered by one request
+MAX_BATCH_ITEMS = 50
+
+
+class BatchSearchResource(Resource):
+    @jwt_required
+    def post(self):
+        """
+        Autocomplete entries and uniqueness checks of a whole form
+        Results are returned in the order of the submitted items
+        """
+
+        search_args = self.search_args()
+
+        logger.debug(
+            "Get batch search request - entries: {}, is_existed: {}".format(
+                len(search_args["entries"]), len(search_args["is_existed"])
+            )
+        )
+
+        for item in search_args["entries"]:
+            if item["field_name"] not in SEARCH_FIELDS:
+                logger.error("Invalid field name.")
+                abort(409)
+
+        entries = [
+            search_field_entries(item["field_name"], item["query"])
+            for item in search_args["entries"]
+        ]
+
+        # Every (field, query) pair is answered, a field may repeat
+        queries = {}
+
+        for item in search_args["is_existed"]:
+            queries.setdefault(item["field"], []).append(item["query"])
+
+        taken = Patient.taken_values(queries)
+
+        return jsonify(
+            {
+                "entries": entries,
+                "is_existed": [
+                    item["query"] in taken.get(item["field"], ())
+                    for item in search_args["is_existed"]
+                ],
+            }
+        )
+
+    def search_args(self):
+        args = {
+            "entries": fields.List(
+                fields.Nested(
+                    {
+                        "field_name": fields.String(required=True),
+                        "query": fields.String(required=True),
+                    }
+                ),
+                missing=[],
+                validate=validate.Length(max=MAX_BATCH_ITEMS),
+            ),
+            "is_existed": fields.List(
+                fields.Nested(
+                    {
+                        "field": fields.String(
+                            required=True,
+                            validate=validate.OneOf(Patient.__unique__),
+                        ),
+                        "query": fields.String(required=True),
+                    }
+                ),
+                missing=[],
+                validate=validate.Length(max=MAX_BATCH_ITEMS),
+            ),
+        }
+
+        # Phrase args data
+        data = parser.parse(args, request, locations=["json"])
+
+        return data
@@ -1,10 +1,16 @@
 from flask_restful import Resource
 from flask import jsonify, abort, request
 from backend.app import db, logger, app
-from sqlalchemy import exc
+from sqlalchemy import exc, func
 from backend.models import Patient, Visit, Lab, Imaging, Appointment
-from webargs import fields
-from marshmallow import validate
+from backend.common.conditional import conditional_response, record_etag
+from backend.common.form_helpers import is_merge_patch, merge_patch_args
+from backend.common.patient_schema import (
+    VISIT_ARGS,
+    LAB_ARGS,
+    IMAGING_ARGS,
+    APPOINTMENT_ARGS,
+)
 from webargs.flaskparser import parser
 from flask_jwt_extended import jwt_required
 
@@ -27,14 +33,17 @@ class ChildResource(Resource):
 
         # Read from DB
         try:
-            patient = Patient.query.filter_by(hn=hn).first()
+            patient_id = db.session.query(Patient.id).filter_by(hn=hn).scalar()
 
-            if not patient:
+            if not patient_id:
                 logger.error(
                     "Child: {}, HN: {}, not found.".format(hn, child_type)
                 )
                 abort(404)
 
+            model = getattr(Patient, child_type).property.mapper.class_
+            children = model.query.filter(model.paitent_id == patient_id)
+
             # Return all children
             if hn and not record_id:
                 page = request.args.get("page", default=1, type=int)
@@ -42,18 +51,32 @@ class ChildResource(Resource):
                     "Returning HN {} {}; page {}.".format(hn, child_type, page)
                 )
 
-                childrenPaginate = getattr(patient, child_type).paginate(
-                    page=page, per_page=app.config["MAX_PAGINATION"]
-                )
+                # Validators of the whole collection, one aggregate
+                no_of_children, last_modified = children.with_entities(
+                    func.count(model.id), func.max(model.modify_timestamp)
+                ).one()
 
-                return jsonify(
-                    {
+                def build():
+                    childrenPaginate = children.order_by(
+                        model.date.desc()
+                    ).paginate(
+                        page=page, per_page=app.config["MAX_PAGINATION"]
+                    )
+
+                    return {
                         "items": childrenPaginate.items,
                         "page": childrenPaginate.page,
                         "pages": childrenPaginate.pages,
                         "total": childrenPaginate.total,
                         "perPage": app.config["MAX_PAGINATION"],
                     }
+
+                # A delete leaves max(modify_timestamp) as it was, only
+                # the ETag with the count validates the collection
+                return conditional_response(
+                    record_etag(no_of_children, last_modified, page),
+                    None,
+                    build,
                 )
 
             # Return specific child
@@ -64,14 +87,18 @@ class ChildResource(Resource):
                     )
                 )
 
-                child = (
-                    getattr(patient, child_type)
+                version = (
+                    children.with_entities(model.id, model.modify_timestamp)
                     .filter_by(id=record_id)
                     .first()
                 )
 
-                if child:
-                    return jsonify(child)
+                if version:
+                    return conditional_response(
+                        record_etag(*version),
+                        version.modify_timestamp,
+                        lambda: model.query.get(version.id),
+                    )
 
                 else:
                     abort(404)
@@ -127,19 +154,20 @@ class ChildResource(Resource):
             if record:
                 # Update the value
                 data = {}
+                partial = is_merge_patch()
 
                 # Form data validation
                 if child_type == "visits":
-                    data = self.visit_form_data()
+                    data = self.visit_form_data(partial)
 
                 elif child_type == "labs":
-                    data = self.lab_form_data()
+                    data = self.lab_form_data(partial)
 
                 elif child_type == "imaging":
-                    data = self.imaging_form_data()
+                    data = self.imaging_form_data(partial)
 
                 elif child_type == "appointments":
-                    data = self.appointment_form_data()
+                    data = self.appointment_form_data(partial)
 
                 else:
                     logger.error("Undefined child type {}.".format(child_type))
@@ -151,11 +179,14 @@ class ChildResource(Resource):
                     )
                 )
 
-                import sys
+                if partial:
+                    changed = record.patch(**data)
+
+                else:
+                    changed = record.update(**data)
 
-                print(data["date"], file=sys.stdout)
+                logger.debug("Changed columns: {}.".format(", ".join(changed)))
 
-                record.update(**data)
                 db.session.add(record)
                 db.session.commit()
 
@@ -257,32 +288,12 @@ class ChildResource(Resource):
             logger.error(e)
             abort(500)
 
-    def visit_form_data(self):
+    def visit_form_data(self, partial=False):
         """
-        Prase JSON from request
+        Prase JSON from request, a partial form is a merge patch
         """
 
-        # JSON Schema
-        json_args = {
-            "date": fields.Date(required=True),
-            "is_art_adherence": fields.String(
-                validate=validate.OneOf(["Yes", "No"])
-            ),
-            "art_delay": fields.Float(),
-            "art_adherence_scale": fields.Float(),
-            "art_adherence_problem": fields.String(),
-            "hx_contact_tb": fields.String(),
-            "bw": fields.Float(),
-            "abn_pe": fields.List(fields.String(allow_missing=True)),
-            "imp": fields.List(
-                fields.String(), validate=validate.Length(min=1)
-            ),
-            "arv": fields.List(fields.String(allow_missing=True)),
-            "why_switched_arv": fields.String(),
-            "oi_prophylaxis": fields.List(fields.String(allow_missing=True)),
-            "anti_tb": fields.List(fields.String(allow_missing=True)),
-            "vaccination": fields.List(fields.String(allow_missing=True)),
-        }
+        json_args = merge_patch_args(VISIT_ARGS) if partial else VISIT_ARGS
 
         # Phrase post data
         data = parser.parse(json_args, request, locations=["json"])
@@ -292,37 +303,12 @@ class ChildResource(Resource):
 
         return data
 
-    def lab_form_data(self):
+    def lab_form_data(self, partial=False):
         """
-        Prase JSON from request
+        Prase JSON from request, a partial form is a merge patch
         """
 
-        # JSON Schema
-        json_args = {
-            "date": fields.Date(required=True),
-            "anti_hiv": fields.String(
-                validate=validate.OneOf(["+", "-", "+/-"])
-            ),
-            "cd4": fields.Integer(),
-            "p_cd4": fields.Float(),
-            "vl": fields.Integer(),
-            "hiv_resistence": fields.String(),
-            "hbsag": fields.String(validate=validate.OneOf(["+", "-", "+/-"])),
-            "anti_hbs": fields.String(
-                validate=validate.OneOf(["+", "-", "+/-"])
-            ),
-            "anti_hcv": fields.String(
-                validate=validate.OneOf(["+", "-", "+/-"])
-            ),
-            "afb": fields.String(
-                validate=validate.OneOf(["3+", "2+", "1+", "Scantly", "-"])
-            ),
-            "sputum_gs": fields.String(),
-            "sputum_cs": fields.String(),
-            "genexpert": fields.String(),
-            "vdrl": fields.String(validate=validate.OneOf(["+", "-", "+/-"])),
-            "rpr": fields.String(validate=validate.Regexp(r"^1:\d+$")),
-        }
+        json_args = merge_patch_args(LAB_ARGS) if partial else LAB_ARGS
 
         # Phrase post data
         data = parser.parse(json_args, request, locations=["json"])
@@ -332,17 +318,12 @@ class ChildResource(Resource):
 
         return data
 
-    def imaging_form_data(self):
+    def imaging_form_data(self, partial=False):
         """
-        Prase JSON from request
+        Prase JSON from request, a partial form is a merge patch
         """
 
-        # JSON Schema
-        json_args = {
-            "date": fields.Date(required=True),
-            "film_type": fields.String(required=True),
-            "result": fields.String(required=True),
-        }
+        json_args = merge_patch_args(IMAGING_ARGS) if partial else IMAGING_ARGS
 
         # Phrase post data
         data = parser.parse(json_args, request, locations=["json"])
@@ -352,16 +333,14 @@ class ChildResource(Resource):
 
         return data
 
-    def appointment_form_data(self):
+    def appointment_form_data(self, partial=False):
         """
-        Prase JSON from request
+        Prase JSON from request, a partial form is a merge patch
         """
 
-        # JSON Schema
-        json_args = {
-            "date": fields.Date(required=True),
-            "appointment_for": fields.String(required=True),
-        }
+        json_args = (
+            merge_patch_args(APPOINTMENT_ARGS) if partial else APPOINTMENT_ARGS
+        )
 
         # Phrase post data
         data = parser.parse(json_args, request, locations=["json"])
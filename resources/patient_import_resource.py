@@ -0,0 +1,51 @@
+from flask_restful import Resource
+from backend.common.patient_import import FORMATS, import_patients
+from flask import Response, request, stream_with_context
+from backend.app import db, logger
+from webargs import fields
+from marshmallow import validate
+from webargs.flaskparser import parser
+from flask_jwt_extended import jwt_required
+import json
+import io
+
+
+class PatientImportResource(Resource):
+    @jwt_required
+    def post(self):
+        """
+        Import the patients of an NDJSON or CSV body
+        Streams one NDJSON result line per row as batches are committed
+        """
+
+        import_args = self.import_args()
+
+        logger.debug(
+            "Recieved patient import, format: {}.".format(
+                import_args["format"]
+            )
+        )
+
+        lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+
+        def report():
+            for result in import_patients(
+                db.session, lines, format=import_args["format"]
+            ):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+        return Response(
+            stream_with_context(report()), mimetype="application/x-ndjson"
+        )
+
+    def import_args(self):
+        args = {
+            "format": fields.String(
+                missing="ndjson", validate=validate.OneOf(FORMATS)
+            )
+        }
+
+        # Phrase args data
+        data = parser.parse(args, request, locations=["querystring"])
+
+        return data
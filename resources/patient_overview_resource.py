@@ -0,0 +1,48 @@
+from flask_restful import Resource
+from backend.models import Patient
+from backend.common.patient_overview import patient_overview
+from flask import jsonify, abort, request
+from backend.app import app, logger
+from webargs import fields
+from marshmallow import validate
+from webargs.flaskparser import parser
+from flask_jwt_extended import jwt_required
+from datetime import date
+
+
+class PatientOverviewResource(Resource):
+    @jwt_required
+    def get(self, hn=None):
+        """
+        Patient record with the latest children and derived values
+        """
+
+        overview_args = self.overview_args()
+        hn = hn.replace("^", "/")
+
+        patient = Patient.query.filter_by(hn=hn).first()
+
+        if patient is None:
+            logger.error("HN {} not found.".format(hn))
+            abort(404)
+
+        logger.debug("Returning overview of HN {}.".format(hn))
+
+        return jsonify(
+            patient_overview(patient, date.today(), overview_args["limit"])
+        )
+
+    def overview_args(self):
+        args = {
+            "limit": fields.Integer(
+                missing=app.config["MAX_PAGINATION"],
+                validate=validate.Range(
+                    min=1, max=app.config["MAX_PAGINATION"]
+                ),
+            )
+        }
+
+        # Phrase args data
+        data = parser.parse(args, request, locations=["querystring"])
+
+        return data
@@ -1,10 +1,12 @@
 from flask_restful import Resource
 from backend.models import Patient
+from backend.common.patient_schema import PATIENT_ARGS
+from backend.common.conditional import conditional_response, record_etag
+from backend.common.form_helpers import is_merge_patch, merge_patch_args
 from flask import jsonify, abort, request
 from backend.app import db, logger
 from sqlalchemy import func, exc
-from webargs import fields
-from marshmallow import validate
+from psycopg2.errorcodes import UNIQUE_VIOLATION
 from webargs.flaskparser import parser
 from flask_jwt_extended import jwt_required
 
@@ -28,15 +30,24 @@ class PatientResource(Resource):
         else:
             hn = hn.replace("^", "/")
 
-        patient = Patient.query.filter_by(hn=hn).first()
+        # Validators of the record, the row itself is not loaded yet
+        version = (
+            db.session.query(Patient.id, Patient.modify_timestamp)
+            .filter_by(hn=hn)
+            .first()
+        )
 
-        if patient is None:
+        if version is None:
             logger.error("HN {} not found.".format(hn))
             abort(404)
 
         else:
             logger.info("Found HN {}.".format(hn))
-            return jsonify(patient)
+            return conditional_response(
+                record_etag(*version),
+                version.modify_timestamp,
+                lambda: Patient.query.get(version.id),
+            )
 
     @jwt_required
     def post(self, hn=None):
@@ -47,31 +58,6 @@ class PatientResource(Resource):
         logger.debug("Recieved POST request.")
         data = self.form_data()
 
-        # Check if the patient exists in db
-        is_patient_exists = Patient.is_exists(
-            col=Patient.hn, str_filter=data["hn"]
-        )
-
-        if is_patient_exists:
-            logger.debug("HN {} existed in DB.".format(data["hn"]))
-            abort(409)
-
-        # Check for uniqueness
-        for col in Patient.__unique__:
-            try:
-                if col not in data:
-                    continue
-
-                column = getattr(Patient, col)
-                is_exists = Patient.is_exists(col=column, str_filter=data[col])
-
-                if is_exists:
-                    logger.warn("Submitted data failed the uniqueness test.")
-                    abort(409)
-
-            except (IndexError, KeyError, exc.SQLAlchemyError) as e:
-                logger.debug(e)
-
         try:
             logger.debug("Saving HN {} in DB.".format(data["hn"]))
 
@@ -80,6 +66,10 @@ class PatientResource(Resource):
             db.session.commit()
             return jsonify({"result": "success"})
 
+        except exc.IntegrityError as e:
+            db.session.rollback()
+            return self.conflict_response(data, e)
+
         except (IndexError, exc.SQLAlchemyError) as e:
             logger.error("Unable to commit to DB.")
             logger.error(e)
@@ -100,55 +90,42 @@ class PatientResource(Resource):
         else:
             hn = hn.replace("^", "/")
 
-        data = self.form_data()
+        partial = is_merge_patch()
+        data = self.form_data(partial)
 
-        if data["hn"] != hn:
+        if data.get("hn", hn) != hn:
             logger.error("Recieved two different HNs.")
             abort(409)
 
-        # Check if the patient exists in the db
-        is_patient_exists = Patient.is_exists(
-            col=Patient.hn, str_filter=data["hn"]
-        )
+        patient = Patient.query.filter_by(hn=hn).first()
 
-        if not is_patient_exists:
-            logger.error("HN {} not found in DB".format(data["hn"]))
+        if patient is None:
+            logger.error("HN {} not found in DB".format(hn))
             abort(404)
 
-        # Check for uniqueness
-        for col in Patient.__unique__:
-            try:
-                column = getattr(Patient, col)
-                is_exists = (
-                    Patient.query.with_entities(Patient.hn)
-                    .filter(column == data[col])
-                    .filter(Patient.hn != data["hn"])
-                    .scalar()
-                )
+        patient_id = patient.id
 
-                if is_exists:
-                    logger.debug(
-                        "str_filter: {} existed in column: {}.".format(
-                            data[col]
-                        ),
-                        col,
-                    )
-                    abort(409)
+        try:
+            logger.debug("Patiching HN {} in DB.".format(hn))
 
-            except (IndexError, KeyError, exc.SQLAlchemyError):
-                pass
+            if partial:
+                changed = patient.patch(**data)
 
-        try:
-            logger.debug("Patiching HN {} in DB.".format(data["hn"]))
+            else:
+                changed = patient.update(**data)
+
+            logger.debug("Changed columns: {}.".format(", ".join(changed)))
 
-            patient = Patient.query.filter_by(hn=data["hn"]).first()
-            patient.update(**data)
             db.session.add(patient)
             db.session.commit()
 
             return jsonify({"result": "success"})
 
-        except (IndexError, exc.SQLAlchemyError, exc.IntegrityError) as e:
+        except exc.IntegrityError as e:
+            db.session.rollback()
+            return self.conflict_response(data, e, exclude_id=patient_id)
+
+        except (IndexError, exc.SQLAlchemyError) as e:
             logger.error("Unable to commit to DB.")
             logger.error(e)
             abort(500)
@@ -170,7 +147,7 @@ class PatientResource(Resource):
 
         try:
             # Check if the patient exists in the db
-            patient = Patient.query.filter_by(hn=hn)
+            patient = Patient.query.filter_by(hn=hn).first()
 
             if patient is None:
                 logger.error("HN {} not found in DB".format(hn))
@@ -188,86 +165,40 @@ class PatientResource(Resource):
             logger.error(e)
             abort(500)
 
-    def form_data(self):
+    def conflict_response(self, data, error, exclude_id=None):
         """
-        Prase JSON from request
+        409 listing the unique fields already used by another patient
+        The unique constraints are the check, the query only runs after
+        one of them rejected the write
         """
 
-        # JSON Schema
-        json_args = {
-            "gov_id_type": fields.String(
-                validate=validate.OneOf(["บัตรประชาชน", "พาสปอร์ต"])
-            ),
-            "gov_id": fields.String(),
-            "name": fields.String(required=True),
-            "dob": fields.Date(),
-            "first_encounter": fields.Date(),
-            "sex": fields.String(
-                validate=validate.OneOf(["ชาย", "หญิง"]), required=True
-            ),
-            "gender": fields.String(
-                validate=validate.OneOf(
-                    ["Male", "Female", "MSM", "Bisexual", "Lesbian", "TG"]
-                ),
-                required=True,
-            ),
-            "marital": fields.String(
-                validate.OneOf(["โสด", "สมรส", "หย่าร้าง", "ม่าย"])
-            ),
-            "nationality": fields.String(required=True),
-            "education": fields.String(
-                validate=validate.OneOf(
-                    [
-                        "ต่ำกว่ามัธยมศึกษาตอนปลาย",
-                        "มัธยมศึกษาตอนปลาย",
-                        "ปวช/ปวส",
-                        "ปริญญาตรี",
-                        "ปริญญาโท",
-                        "ปริญญาเอก",
-                    ]
-                )
-            ),
-            "address": fields.String(),
-            "tel": fields.List(fields.String(allow_missing=True)),
-            "relative_tel": fields.List(fields.String(allow_missing=True)),
-            "is_refer": fields.String(
-                required=True,
-                validate=validate.OneOf(
-                    [
-                        "ผู้ป่วยใหม่",
-                        "ผู้ป่วยรับโอน (ยังไม่เริ่ม ARV)",
-                        "ผู้ป่วยรับโอน (เริ่ม ARV แล้ว)",
-                    ]
-                ),
-            ),
-            "refer_from": fields.String(),
-            "hn": fields.String(required=True),
-            "hiv_clinic_id": fields.String(),
-            "nap": fields.String(),
-            "bill_payer": fields.String(
-                required=True,
-                validate=validate.OneOf(
-                    [
-                        "ประกันสุขภาพทั่วหน้า",
-                        "ประกันสุขภาพทั่วหน้า นอกเขต",
-                        "ประกันสังคม",
-                        "ประกันสังคม ต่างรพ.",
-                        "ข้าราชการ/จ่ายตรง",
-                        "ต่างด้าว",
-                        "ชำระเงิน",
-                    ]
-                ),
-            ),
-            "plans": fields.List(
-                fields.Nested(
-                    {
-                        "date": fields.Date(required=True),
-                        "plan": fields.String(required=True),
-                    },
-                    allow_missing=True,
-                )
-            ),
-        }
+        if getattr(error.orig, "pgcode", None) != UNIQUE_VIOLATION:
+            logger.error("Unable to commit to DB.")
+            logger.error(error)
+            abort(500)
+
+        conflicts = Patient.existing_values(
+            {col: data.get(col) for col in Patient.__unique__},
+            exclude_id=exclude_id,
+        )
+
+        logger.warn(
+            "Submitted data failed the uniqueness test, fields: {}.".format(
+                ", ".join(sorted(conflicts))
+            )
+        )
+
+        response = jsonify({"result": "conflict", "fields": sorted(conflicts)})
+        response.status_code = 409
+
+        return response
+
+    def form_data(self, partial=False):
+        """
+        Prase JSON from request, a partial form is a merge patch
+        """
+
+        json_args = merge_patch_args(PATIENT_ARGS) if partial else PATIENT_ARGS
 
         # Phrase post data
         data = parser.parse(json_args, request, locations=["json"])
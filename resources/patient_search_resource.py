@@ -0,0 +1,60 @@
+from flask_restful import Resource
+from backend.common.patient_search import search_patients, estimated_matches
+from flask import jsonify, abort, request
+from backend.app import app, logger
+from webargs import fields
+from marshmallow import validate
+from webargs.flaskparser import parser
+from flask_jwt_extended import jwt_required
+
+
+class PatientSearchResource(Resource):
+    @jwt_required
+    def get(self):
+        """
+        Ranked patient search, pages follow the returned cursor
+        """
+
+        search_args = self.search_args()
+
+        logger.debug(
+            "Searching patients - query: {}, cursor: {}".format(
+                search_args["query"], search_args["cursor"]
+            )
+        )
+
+        try:
+            items, next_cursor = search_patients(
+                search_args["query"],
+                search_args["limit"],
+                search_args["cursor"],
+            )
+
+        except ValueError as e:
+            logger.error(e)
+            abort(422)
+
+        return jsonify(
+            {
+                "items": items,
+                "next": next_cursor,
+                "estimatedTotal": estimated_matches(search_args["query"]),
+            }
+        )
+
+    def search_args(self):
+        args = {
+            "query": fields.String(required=True),
+            "cursor": fields.String(missing=None),
+            "limit": fields.Integer(
+                missing=app.config["MAX_SEARCH_RESULT"],
+                validate=validate.Range(
+                    min=1, max=app.config["MAX_SEARCH_RESULT"]
+                ),
+            ),
+        }
+
+        # Phrase args data
+        data = parser.parse(args, request, locations=["querystring"])
+
+        return data